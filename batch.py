@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Literal, Tuple
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from cache import execution_cache
+from exporter import OutputFormat
+from pyrunner import CellRecord, KernelPool
+from schema import DataFrameInfo, QueryPrompt
+from utils import acall_openai_llm, extract_code
+
+_worker_pool: KernelPool = None
+
+
+class BatchJob(BaseModel):
+    job_id: str = Field(description='任务标识，同时作为输出目录名称')
+    query: str = Field(description='用户提问')
+    dfs: List[DataFrameInfo] = Field(description='表名称以及描述')
+    data_format: Literal['source', 'parquet', 'arrow'] = Field('parquet', description='生成的读取代码加载数据的方式')
+    engine: Literal['pandas', 'duckdb'] = Field('pandas', description='生成代码使用的计算引擎')
+    output_format: OutputFormat = Field('csv', description='输出结果的文件格式')
+
+    def to_prompt(self, output_dir: Path) -> QueryPrompt:
+        return QueryPrompt(dfs=self.dfs, query=self.query, file_name=output_dir / self.job_id / 'output.csv',
+                           data_format=self.data_format, engine=self.engine, output_format=self.output_format)
+
+
+class BatchManifest(BaseModel):
+    jobs: List[BatchJob] = Field(description='批量任务列表')
+
+
+class JobReport(BaseModel):
+    job_id: str = Field(description='任务标识')
+    status: Literal['pending', 'success', 'llm_error', 'exec_error'] = Field('pending', description='任务状态')
+    error: str | None = Field(None, description='错误信息')
+    output_path: Path | None = Field(None, description='输出结果文件')
+    code_path: Path | None = Field(None, description='完整执行代码文件')
+    prompt_seconds: float = Field(0.0, description='构建提示词耗时')
+    llm_seconds: float = Field(0.0, description='模型请求耗时')
+    queue_seconds: float = Field(0.0, description='等待执行耗时')
+    exec_seconds: float = Field(0.0, description='代码执行耗时')
+    cells: List[CellRecord] = Field(default_factory=list, description='每个代码块的执行记录')
+    cached: bool = Field(False, description='是否命中执行结果缓存')
+
+
+def _init_worker(ipython_dir: str):
+    # 每个子进程持有一个预热好的内核，进程之间互不影响
+    global _worker_pool
+    _worker_pool = KernelPool(Path(ipython_dir), size=1).start()
+
+
+def _run_cells(cells: List[str]) -> Tuple[str, str | None, List[CellRecord]]:
+    with _worker_pool.lease() as kernel:
+        out, err = kernel.run(cells)
+        return out, err, kernel.records
+
+
+async def run_batch(manifest: BatchManifest,
+                    ipython_dir: Path,
+                    output_dir: Path = Path('./outputs'),
+                    workers: int = 2,
+                    max_pending: int = None,
+                    model: str = 'gpt-3.5-turbo') -> List[JobReport]:
+    loop = asyncio.get_running_loop()
+    reports = {job.job_id: JobReport(job_id=job.job_id) for job in manifest.jobs}
+    queue: asyncio.Queue = asyncio.Queue()
+    # 限制已开始生成但尚未执行完成的任务数量，模型请求不会远远领先于代码执行
+    in_flight = asyncio.Semaphore(max_pending or workers * 2)
+
+    async def generate(job: BatchJob):
+        await in_flight.acquire()
+        report = reports[job.job_id]
+        try:
+            start = time.perf_counter()
+            p = job.to_prompt(output_dir)
+            prompt = await asyncio.to_thread(p.generate_prompt)
+            report.prompt_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            completion = await acall_openai_llm([{'role': 'user', 'content': prompt}], model=model)
+            define_function_code = extract_code(completion)
+            report.llm_seconds = time.perf_counter() - start
+        except Exception as e:
+            logger.error(f'{job.job_id}: error to generate code')
+            report.status, report.error = 'llm_error', str(e)
+            in_flight.release()
+            return
+        await queue.put((job, p, define_function_code, time.perf_counter()))
+
+    async def execute():
+        while (item := await queue.get()) is not None:
+            job, p, define_function_code, queued_at = item
+            report = reports[job.job_id]
+            report.queue_seconds = time.perf_counter() - queued_at
+
+            job_dir = output_dir / job.job_id
+            job_dir.mkdir(parents=True, exist_ok=True)
+            cells = p.code_cells(define_function_code)
+            report.code_path = job_dir / 'code.py'
+            report.code_path.write_text('\n'.join(cells))
+
+            start = time.perf_counter()
+            execution_key = p.execution_key(define_function_code)
+            if (cached := execution_cache.get(execution_key, p.file_name)) is not None:
+                out, err = cached
+                report.cached = True
+            else:
+                try:
+                    out, err, report.cells = await loop.run_in_executor(executor, _run_cells, cells)
+                except Exception as e:
+                    out, err = '', str(e)
+                if err is None:
+                    execution_cache.set(execution_key, out, err, p.file_name)
+            report.exec_seconds = time.perf_counter() - start
+            (job_dir / 'run.log').write_text(out + (err or ''))
+
+            if err is None:
+                logger.info(f'{job.job_id}: success to run code')
+                report.status, report.output_path = 'success', p.file_name
+            else:
+                logger.error(f'{job.job_id}: error to run code')
+                report.status, report.error = 'exec_error', err
+            in_flight.release()
+
+    # 提示词在 asyncio.to_thread 的线程中生成，使用 spawn 避免 fork 时复制其他线程持有的锁
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(str(ipython_dir),),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        executors = [asyncio.create_task(execute()) for _ in range(workers)]
+        await asyncio.gather(*(generate(job) for job in manifest.jobs))
+        for _ in executors:
+            await queue.put(None)
+        await asyncio.gather(*executors)
+
+    result = [reports[job.job_id] for job in manifest.jobs]
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / 'report.json').write_text(
+        json.dumps([r.model_dump(mode='json') for r in result], ensure_ascii=False, indent=2), encoding='utf-8')
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='批量生成并执行数据处理代码')
+    parser.add_argument('manifest', type=Path, help='任务清单 json 文件，格式为 {"jobs": [...]}')
+    parser.add_argument('--ipython-dir', type=Path, required=True)
+    parser.add_argument('--output-dir', type=Path, default=Path('./outputs'))
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-pending', type=int, default=None)
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    args = parser.parse_args()
+
+    batch_manifest = BatchManifest.model_validate_json(args.manifest.read_text(encoding='utf-8'))
+    asyncio.run(run_batch(batch_manifest,
+                          ipython_dir=args.ipython_dir,
+                          output_dir=args.output_dir,
+                          workers=args.workers,
+                          max_pending=args.max_pending,
+                          model=args.model))
@@ -0,0 +1,222 @@
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel, Field
+
+from cache import columnar_cache
+from introspect import count_distinct
+from pyrunner import WARMUP_CODE, InteractivePythonRunner
+from schema import DataFrameInfo, QueryPrompt, _scan_table
+from summarize import _summarize
+from utils import extract_code
+
+DEFAULT_SIZES = [10_000, 1_000_000, 10_000_000]
+XLSX_MAX_ROWS = 100_000
+CATEGORIES = ['饰品', '服装', '鞋', '包', '配件', '家居']
+
+BENCH_QUERY = """
+1.打开《库存报表》，将《货品报表》的全部字段，根据”货号”匹配到《库存报表》上；
+2.然后剔除《库存报表》中”类别”为”饰品”和”服装”的记录；
+3.根据”渠道编号”聚合计算”可用库存”和”默认吊牌价”；
+4.最后输出”仓库编码”即”渠道编号”，”仓库名称”即”渠道简称”，”库存总量”即”可用库存”合计，”库存总价值”即”默认吊牌价”合计。
+"""
+
+# 本地替代模型返回的固定代码，保证每次运行执行相同的处理逻辑
+BENCH_COMPLETION = """
+```python
+def process_data(df_0, df_1):
+    df = df_1.merge(df_0, on='货号', how='left')
+    df = df[~df['类别'].isin(['饰品', '服装'])]
+    df = df.groupby('渠道编号').agg(仓库名称=('渠道简称', 'first'),
+                                  库存总量=('可用库存', 'sum'),
+                                  库存总价值=('默认吊牌价', 'sum')).reset_index()
+    return df.rename(columns={'渠道编号': '仓库编码'})
+```
+"""
+
+
+class BenchResult(BaseModel):
+    rows: int = Field(description='库存报表行数')
+    file_format: str = Field(description='输入文件格式')
+    data_format: str = Field(description='生成代码加载数据的方式')
+    output_format: str = Field('csv', description='输出结果的文件格式')
+    stages: Dict[str, float] = Field(default_factory=dict, description='各阶段耗时（秒）')
+    error: str | None = Field(None, description='执行错误')
+
+
+class BenchReport(BaseModel):
+    commit: str = Field('', description='当前 git 提交')
+    python: str = Field(platform.python_version(), description='python 版本')
+    pandas: str = Field(pd.__version__, description='pandas 版本')
+    created_at: float = Field(default_factory=time.time, description='运行时间')
+    results: List[BenchResult] = Field(default_factory=list, description='各规模的测试结果')
+
+
+def git_commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                            cwd=Path(__file__).parent)
+    return result.stdout.strip()
+
+
+def generate_tables(rows: int, seed: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    n_goods = max(rows // 10, 100)
+    n_channels = max(rows // 1000, 10)
+
+    goods_no = np.array([f'G{i:08d}' for i in range(n_goods)])
+    df_goods = pd.DataFrame({'货号': goods_no,
+                             '货品名称': np.char.add('货品', np.arange(n_goods).astype(str)),
+                             '类别': rng.choice(CATEGORIES, n_goods),
+                             '默认吊牌价': rng.integers(10, 2000, n_goods).astype(float)})
+
+    channel_idx = rng.integers(0, n_channels, rows)
+    df_inventory = pd.DataFrame({'渠道编号': np.char.add('C', channel_idx.astype(str)),
+                                 '渠道简称': np.char.add('渠道', channel_idx.astype(str)),
+                                 '货号': goods_no[rng.integers(0, n_goods, rows)],
+                                 '可用库存': rng.integers(0, 500, rows)})
+    return df_goods, df_inventory
+
+
+def prepare_inputs(rows: int, data_dir: Path, file_format: str, seed: int = 0) -> List[DataFrameInfo]:
+    paths = [data_dir / f'货品报表_{rows}_{seed}.{file_format}', data_dir / f'库存报表_{rows}_{seed}.{file_format}']
+    if not all(p.exists() for p in paths):
+        logger.info(f'generate synthetic data: {rows} rows')
+        data_dir.mkdir(parents=True, exist_ok=True)
+        for df, path in zip(generate_tables(rows, seed), paths):
+            if file_format == 'xlsx':
+                df.to_excel(path, index=False)
+            else:
+                df.to_csv(path, index=False)
+    return [DataFrameInfo(name='货品报表', path=paths[0]), DataFrameInfo(name='库存报表', path=paths[1])]
+
+
+def local_llm(messages) -> ChatCompletion:
+    return ChatCompletion.model_validate({
+        'id': 'bench', 'object': 'chat.completion', 'created': 0, 'model': 'bench',
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': BENCH_COMPLETION}}]})
+
+
+@contextmanager
+def timed(stages: Dict[str, float], name: str):
+    start = time.perf_counter()
+    yield
+    stages[name] = time.perf_counter() - start
+
+
+def clear_memoized():
+    # 清空进程内记住的文件哈希、表结构、不同值数量与摘要，下一个阶段从头计算
+    columnar_cache.clear_hashes()
+    _scan_table.cache_clear()
+    count_distinct.cache_clear()
+    _summarize.cache_clear()
+
+
+@contextmanager
+def fresh_columnar_cache():
+    # 每次运行使用新的临时目录作为列式缓存，阶段耗时不受之前运行留下的缓存影响
+    cache_dir = columnar_cache.cache_dir
+    with tempfile.TemporaryDirectory(prefix='bench_columnar_') as tmp:
+        columnar_cache.cache_dir = Path(tmp)
+        clear_memoized()
+        try:
+            yield
+        finally:
+            columnar_cache.cache_dir = cache_dir
+
+
+def run_one(rows: int, data_dir: Path, output_dir: Path, file_format: str, data_format: str,
+            output_format: str = 'csv') -> BenchResult:
+    with fresh_columnar_cache():
+        return _run_one(rows, data_dir, output_dir, file_format, data_format, output_format)
+
+
+def _run_one(rows: int, data_dir: Path, output_dir: Path, file_format: str, data_format: str,
+             output_format: str) -> BenchResult:
+    result = BenchResult(rows=rows, file_format=file_format, data_format=data_format, output_format=output_format)
+    stages = result.stages
+
+    dfs = prepare_inputs(rows, data_dir, file_format)
+    p = QueryPrompt(dfs=dfs, query=BENCH_QUERY, data_format=data_format, output_format=output_format,
+                    file_name=output_dir / f'bench_output_{rows}.csv')
+
+    with timed(stages, 'schema'):
+        for x in dfs:
+            _ = x.table_schema
+    with timed(stages, 'cache'):
+        for x in dfs:
+            if data_format == 'arrow':
+                _ = x.arrow_path
+            elif data_format == 'parquet':
+                _ = x.cache_path
+    # 提示词阶段包含其依赖的文件哈希与表结构扫描，列式缓存已在上一阶段生成
+    clear_memoized()
+    with timed(stages, 'prompt'):
+        prompt = p.generate_prompt()
+    with timed(stages, 'llm'):
+        define_function_code = extract_code(local_llm([{'role': 'user', 'content': prompt}]))
+
+    runner = InteractivePythonRunner(data_dir / 'ipython', warmup_code=WARMUP_CODE)
+    with timed(stages, 'kernel_start'):
+        runner.open()
+    try:
+        _, err = runner.run(p.code_cells(define_function_code))
+    finally:
+        runner.close()
+
+    # code_cells 的顺序：导入、读取、定义函数、执行、导出
+    for name, idx in [('load', 1), ('process_data', 3), ('export', 4)]:
+        stages[name] = runner.records[idx].wall_seconds
+    result.error = err
+    return result
+
+
+def compare(current: BenchReport, baseline: BenchReport):
+    base = {(r.rows, r.file_format, r.data_format, r.output_format): r for r in baseline.results}
+    print(f'compare {current.commit} against {baseline.commit}')
+    for r in current.results:
+        if (b := base.get((r.rows, r.file_format, r.data_format, r.output_format))) is None:
+            continue
+        print(f'rows={r.rows} format={r.file_format}/{r.data_format}/{r.output_format}')
+        for stage, seconds in r.stages.items():
+            before = b.stages.get(stage)
+            ratio = f'{seconds / before:6.2f}x' if before else '     -'
+            print(f'  {stage:<14}{seconds:10.3f}s  {ratio}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='使用合成的货品报表/库存报表数据测试全流程各阶段耗时')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--file-format', choices=['auto', 'xlsx', 'csv'], default='auto',
+                        help=f'auto 表示不超过 {XLSX_MAX_ROWS} 行时使用 xlsx，否则使用 csv')
+    parser.add_argument('--data-format', choices=['source', 'parquet', 'arrow'], default='parquet')
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'arrow'], default='csv')
+    parser.add_argument('--data-dir', type=Path, default=Path('./.cache/benchmark'))
+    parser.add_argument('--output', type=Path, default=Path('./outputs/benchmark.json'))
+    parser.add_argument('--compare', type=Path, default=None, help='与之前的测试报告进行对比')
+    args = parser.parse_args()
+
+    report = BenchReport(commit=git_commit())
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    for size in args.sizes:
+        fmt = args.file_format
+        if fmt == 'auto':
+            fmt = 'xlsx' if size <= XLSX_MAX_ROWS else 'csv'
+        report.results.append(run_one(size, args.data_dir, args.output.parent, fmt, args.data_format,
+                                      args.output_format))
+        logger.info(report.results[-1].model_dump())
+
+    args.output.write_text(json.dumps(report.model_dump(), ensure_ascii=False, indent=2), encoding='utf-8')
+    if args.compare is not None:
+        compare(report, BenchReport.model_validate_json(args.compare.read_text(encoding='utf-8')))
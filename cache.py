@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, List, Literal, Tuple
+
+import pandas as pd
+from loguru import logger
+
+DEFAULT_CACHE_DIR = Path().absolute() / '.cache' / 'columnar'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_source(path: Path, **kwargs) -> pd.DataFrame:
+    suffix = path.suffix
+    if suffix == '.xlsx':
+        return pd.read_excel(path, **kwargs)
+    if suffix == '.csv':
+        return pd.read_csv(path, **kwargs)
+    raise Exception('not found')
+
+
+def _tmp_path(target: Path) -> Path:
+    # 后台进程与页面可能同时写入同一个缓存文件，临时文件名不能冲突，最终替换是原子的
+    return target.with_name(f'{target.stem}.{uuid.uuid4().hex}.tmp')
+
+
+def write_parquet(df: pd.DataFrame, target: Path):
+    tmp = _tmp_path(target)
+    try:
+        df.to_parquet(tmp, index=False)
+    except Exception:
+        # excel 中混合类型的列无法直接写入 parquet，统一转为字符串
+        obj_cols = df.select_dtypes(include='object').columns
+        df = df.astype({c: 'string' for c in obj_cols})
+        df.to_parquet(tmp, index=False)
+    tmp.replace(target)
+
+
+# 以文件内容哈希为键，将 xlsx/csv 转换为 parquet/arrow 缓存，超过容量上限时按最近访问时间淘汰
+class ColumnarCache:
+
+    def __init__(self, cache_dir: Path = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._hashes: Dict[Tuple[str, int, int], str] = {}
+        self._lock = threading.RLock()
+
+    def content_hash(self, path: Path) -> str:
+        # 同一进程内用 (路径, 大小, 修改时间) 记住哈希，避免重复读取整个文件
+        stat = path.stat()
+        key = (str(path.absolute()), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            self._hashes[key] = file_hash(path)
+        return self._hashes[key]
+
+    def remember_hash(self, path: Path, digest: str):
+        # 写入文件时已经计算过哈希，直接记录，后续不需要重新读取文件
+        stat = path.stat()
+        self._hashes[(str(path.absolute()), stat.st_size, stat.st_mtime_ns)] = digest
+
+    def clear_hashes(self):
+        self._hashes.clear()
+
+    def cache_path(self, path: Path, fmt: Literal['parquet', 'arrow'] = 'parquet') -> Path:
+        return self.cache_dir / f'{self.content_hash(path)}.{fmt}'
+
+    def get(self, path: Path, fmt: Literal['parquet', 'arrow'] = 'parquet') -> Path:
+        # 数据对齐后的文件本身就是 parquet，直接使用
+        if fmt == 'parquet' and path.suffix == '.parquet':
+            return path
+        target = self.cache_path(path, fmt)
+        with self._lock:
+            if target.exists():
+                os.utime(target)
+                return target
+
+            logger.info(f'convert {path} to columnar cache: {target.name}')
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            if fmt == 'parquet':
+                write_parquet(read_source(path), target)
+            else:
+                # arrow 文件由 parquet 缓存转换得到，源文件只解析一次
+                self._write_arrow(self.get(path, 'parquet'), target)
+            self._evict(keep=target)
+            return target
+
+    def load(self, path: Path, **kwargs) -> pd.DataFrame:
+        return pd.read_parquet(self.get(path), **kwargs)
+
+    @staticmethod
+    def _write_arrow(source: Path, target: Path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # 不压缩的 arrow ipc 文件可以直接内存映射，多个内核共享同一份物理内存
+        table = pq.read_table(source)
+        tmp = _tmp_path(target)
+        with pa.OSFile(str(tmp), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        tmp.replace(target)
+
+    def _evict(self, keep: Path):
+        files = [f for f in self.cache_dir.iterdir() if f.suffix in ('.parquet', '.arrow')]
+        files = sorted(files, key=lambda x: x.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        for f in files:
+            if total <= self.max_bytes:
+                break
+            if f == keep:
+                continue
+            total -= f.stat().st_size
+            logger.info(f'evict columnar cache: {f.name}')
+            f.unlink(missing_ok=True)
+
+
+columnar_cache = ColumnarCache()
+
+
+DEFAULT_RESULT_CACHE_DIR = Path().absolute() / '.cache' / 'results'
+DEFAULT_RESULT_MAX_BYTES = 1024 ** 3
+
+
+# 以 (完整执行代码, 所有输入文件内容哈希) 为键缓存执行结果，命中时直接复制输出文件，不需要启动内核
+class ExecutionCache:
+
+    def __init__(self, cache_dir: Path = DEFAULT_RESULT_CACHE_DIR, max_bytes: int = DEFAULT_RESULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(cells: List[str], input_paths: List[Path]) -> str:
+        raw = json.dumps({'cells': cells, 'inputs': [columnar_cache.content_hash(p) for p in input_paths]},
+                         ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str, output_path: Path) -> Tuple[str, str | None] | None:
+        entry = self.cache_dir / key
+        with self._lock:
+            if not (entry / 'log.json').exists():
+                return None
+
+            log = json.loads((entry / 'log.json').read_text(encoding='utf-8'))
+            if (stored := entry / 'output').exists():
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(stored, output_path)
+            os.utime(entry)
+            logger.info(f'execution cache hit: {key}')
+            return log['out'], log['err']
+
+    def cells(self, key: str) -> List[str] | None:
+        # 经过修复的结果会同时保存在首次代码的键下，记录实际执行成功的代码
+        log = self.cache_dir / key / 'log.json'
+        return json.loads(log.read_text(encoding='utf-8')).get('cells') if log.exists() else None
+
+    def set(self, key: str, out: str, err: str | None, output_path: Path, cells: List[str] = None):
+        entry = self.cache_dir / key
+        with self._lock:
+            entry.mkdir(parents=True, exist_ok=True)
+            if output_path.exists():
+                shutil.copyfile(output_path, entry / 'output')
+            (entry / 'log.json').write_text(json.dumps({'out': out, 'err': err, 'cells': cells}, ensure_ascii=False),
+                                            encoding='utf-8')
+            self._evict(keep=entry)
+
+    def _evict(self, keep: Path):
+        entries = sorted((d for d in self.cache_dir.iterdir() if d.is_dir()), key=lambda x: x.stat().st_mtime)
+        sizes = {d: sum(f.stat().st_size for f in d.iterdir()) for d in entries}
+        total = sum(sizes.values())
+        for d in entries:
+            if total <= self.max_bytes:
+                break
+            if d == keep:
+                continue
+            total -= sizes[d]
+            shutil.rmtree(d, ignore_errors=True)
+
+
+execution_cache = ExecutionCache()
@@ -0,0 +1,176 @@
+import asyncio
+import shutil
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Literal, Tuple
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from pyrunner import ExecutionPolicy, PythonRunner, SandboxEnvPool
+from schema import DataFrameInfo, QueryPrompt
+from utils import acall_openai_llm, extract_code
+
+
+class CandidateResult(BaseModel):
+    index: int = Field(description='候选序号')
+    status: Literal['pending', 'success', 'error', 'llm_error', 'timeout', 'cancelled'] = Field('pending',
+                                                                                               description='候选状态')
+    code: str = Field('', description='生成的 process_data 代码')
+    error: str | None = Field(None, description='错误信息')
+    llm_seconds: float = Field(0.0, description='模型请求耗时')
+    exec_seconds: float = Field(0.0, description='代码执行耗时')
+    peak_rss_bytes: int = Field(0, description='执行进程的峰值常驻内存')
+
+
+async def _run_script(python: Path, script: Path, cwd: Path, result: CandidateResult, policy: ExecutionPolicy) -> bool:
+    runner = PythonRunner(interpreter_path=python, policy=policy, cwd=cwd)
+    stop = threading.Event()
+    future = asyncio.ensure_future(asyncio.to_thread(runner.run_script, script, stop))
+    try:
+        script_result = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # 其他候选已经成功，通知执行线程结束进程，等待进程退出后再取消
+        stop.set()
+        await future
+        raise
+
+    result.exec_seconds = script_result.wall_seconds
+    result.peak_rss_bytes = script_result.peak_rss_bytes
+    if script_result.exit_reason == 'ok':
+        result.status = 'success'
+        return True
+    if script_result.exit_reason == 'timeout':
+        result.status, result.error = 'timeout', f'执行超过 {policy.timeout_seconds} 秒'
+    else:
+        result.status = 'error'
+        result.error = script_result.stderr if script_result.exit_reason == 'error' else \
+            f'{script_result.exit_reason} limit exceeded\n{script_result.stderr}'
+    return False
+
+
+async def _candidate(p: QueryPrompt,
+                     prompt: str,
+                     result: CandidateResult,
+                     work_dir: Path,
+                     model: str,
+                     temperature: float,
+                     python: Path,
+                     pool: SandboxEnvPool | None,
+                     policy: ExecutionPolicy) -> CandidateResult:
+    start = time.perf_counter()
+    try:
+        # 多个候选使用相同的提示词，需要跳过缓存才能得到不同的采样结果
+        completion = await acall_openai_llm([{'role': 'user', 'content': prompt}],
+                                            model=model, temperature=temperature, use_cache=False)
+        result.code = extract_code(completion)
+    except Exception as e:
+        result.status, result.error = 'llm_error', str(e)
+        return result
+    finally:
+        result.llm_seconds = time.perf_counter() - start
+
+    candidate = p.model_copy(update={'file_name': work_dir / f'candidate_{result.index}{p.file_name.suffix}'})
+    script = work_dir / f'candidate_{result.index}.py'
+    script.write_text('\n'.join(candidate.code_cells(result.code)))
+
+    if pool is None:
+        # 不使用沙箱时每个候选在单独的目录中执行，相对路径的写入互不影响
+        cwd = work_dir / f'candidate_{result.index}'
+        cwd.mkdir(exist_ok=True)
+        await _run_script(python, script, cwd, result, policy)
+        return result
+
+    lease = pool.lease()
+    env = await asyncio.to_thread(lease.__enter__)
+    try:
+        await _run_script(env.python_path, script, env.work_dir, result, policy)
+    finally:
+        await asyncio.to_thread(lease.__exit__, None, None, None)
+    return result
+
+
+async def solve(p: QueryPrompt,
+                n: int = 4,
+                model: str = 'gpt-3.5-turbo',
+                temperature: float = 0.8,
+                work_dir: Path = Path('./outputs/candidates'),
+                python: Path = Path(sys.executable),
+                pool: SandboxEnvPool = None,
+                timeout: float = None,
+                policy: ExecutionPolicy = None) -> Tuple[CandidateResult | None, List[CandidateResult]]:
+    # 并发采样 n 个 process_data 实现并同时执行，第一个执行成功的候选胜出，其余候选立即取消
+    # 建议搭配 data_format='arrow' 使用，所有候选进程内存映射同一份输入数据
+    # 每个候选的执行受 policy 限制，timeout 为单个候选的最长执行时间，覆盖 policy 中的设置
+    policy = policy or ExecutionPolicy()
+    if timeout is not None:
+        policy = policy.model_copy(update={'timeout_seconds': timeout})
+    work_dir.mkdir(parents=True, exist_ok=True)
+    prompt = await asyncio.to_thread(p.generate_prompt)
+
+    results: Dict[int, CandidateResult] = {i: CandidateResult(index=i) for i in range(n)}
+    tasks = [asyncio.create_task(_candidate(p, prompt, results[i], work_dir, model, temperature, python, pool, policy))
+             for i in range(n)]
+
+    winner = None
+    try:
+        for finished in asyncio.as_completed(tasks):
+            result = await finished
+            if result.status == 'success':
+                winner = result
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for result in results.values():
+        if result.status == 'pending':
+            result.status = 'cancelled'
+
+    if winner is None:
+        logger.error(f'all {n} candidates failed')
+        return None, list(results.values())
+
+    logger.info(f'candidate {winner.index} wins after {winner.llm_seconds + winner.exec_seconds:.2f}s')
+    p.file_name.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(work_dir / f'candidate_{winner.index}{p.file_name.suffix}', p.file_name)
+    return winner, list(results.values())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='并发生成并执行多个候选实现，使用第一个执行成功的结果')
+    parser.add_argument('inputs', type=Path, nargs='+', help='输入的 xlsx/csv 文件，表名为文件名')
+    parser.add_argument('--query', required=True, help='需求描述')
+    parser.add_argument('-n', type=int, default=4, help='候选数量')
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    parser.add_argument('--temperature', type=float, default=0.8)
+    parser.add_argument('--timeout', type=float, default=None, help='单个候选的最长执行时间（秒）')
+    parser.add_argument('--max-rss-mb', type=int, default=None, help='单个候选的最大常驻内存（MB）')
+    parser.add_argument('--output', type=Path, default=Path('./outputs/output.csv'))
+    parser.add_argument('--sandbox', action='store_true', help='在基于当前解释器创建的沙箱环境中执行')
+    args = parser.parse_args()
+
+    dfs = [DataFrameInfo(name=path.stem, path=path) for path in args.inputs]
+    p = QueryPrompt(dfs=dfs, query=args.query, data_format='arrow', file_name=args.output.absolute())
+    policy = ExecutionPolicy(timeout_seconds=args.timeout,
+                             max_rss_bytes=None if args.max_rss_mb is None else args.max_rss_mb * 1024 ** 2)
+    pool = SandboxEnvPool(base_python=Path(sys.executable), size=min(args.n, 4)).start() if args.sandbox else None
+    try:
+        winner, results = asyncio.run(solve(p, n=args.n, model=args.model, temperature=args.temperature,
+                                            pool=pool, policy=policy))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for r in results:
+        logger.info(f'candidate {r.index}: {r.status} llm={r.llm_seconds:.2f}s exec={r.exec_seconds:.2f}s '
+                    f'rss={r.peak_rss_bytes / 1024 ** 2:.1f}MB')
+        if r.error:
+            logger.info(r.error)
+    if winner is not None:
+        logger.info(f'output: {p.file_name}')
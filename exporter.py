@@ -0,0 +1,182 @@
+import textwrap
+import time
+from pathlib import Path
+from typing import Iterator, List, Literal
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydantic import BaseModel, Field
+
+OutputFormat = Literal['csv', 'parquet', 'arrow']
+OUTPUT_SUFFIX = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+DEFAULT_CHUNK_ROWS = 256 * 1024
+
+
+class ExportStats(BaseModel):
+    path: Path = Field(description='输出文件')
+    output_format: str = Field(description='输出格式')
+    rows: int | None = Field(None, description='写入行数，duckdb 原生写出时未知')
+    bytes_written: int = Field(0, description='写入字节数')
+    seconds: float = Field(0.0, description='写入耗时')
+
+    @property
+    def throughput(self) -> float:
+        # 每秒写入的 MB 数
+        return self.bytes_written / 1024 ** 2 / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        rows = '?' if self.rows is None else self.rows
+        return (f'export {rows} rows to {self.path} ({self.output_format}): '
+                f'{self.bytes_written / 1024 ** 2:.1f}MB in {self.seconds:.3f}s, {self.throughput:.1f}MB/s')
+
+
+def _keep_index(df: pd.DataFrame) -> bool:
+    # 默认的 RangeIndex 没有信息量不写出，groupby 等产生的有意义的索引仍然保留
+    return not isinstance(df.index, pd.RangeIndex)
+
+
+def _pandas_batches(df: pd.DataFrame, schema: pa.Schema, chunk_rows: int) -> Iterator[pa.RecordBatch]:
+    preserve_index = _keep_index(df)
+    for start in range(0, len(df), chunk_rows):
+        yield pa.RecordBatch.from_pandas(df.iloc[start:start + chunk_rows], schema=schema,
+                                         preserve_index=preserve_index)
+
+
+def _write_csv(df: pd.DataFrame, path: Path, chunk_rows: int) -> int:
+    # 分块写入，避免一次性生成整个结果的文本副本
+    index = _keep_index(df)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            df.iloc[start:start + chunk_rows].to_csv(f, index=index, header=start == 0)
+    return len(df)
+
+
+def _write_batches(batches: Iterator[pa.RecordBatch], schema: pa.Schema, path: Path,
+                   output_format: OutputFormat) -> int:
+    rows = 0
+    if output_format == 'parquet':
+        with pq.ParquetWriter(path, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    else:
+        # 不压缩的 IPC 文件，下游可以直接内存映射读取
+        with pa.ipc.new_file(path, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    return rows
+
+
+def export_frame(df_result,
+                 path: str | Path,
+                 output_format: OutputFormat = 'csv',
+                 chunk_rows: int = DEFAULT_CHUNK_ROWS) -> ExportStats:
+    # 支持 pandas DataFrame 以及 duckdb 关系对象，按 chunk_rows 行一块流式写出，并返回写入的字节数与吞吐
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+
+    if isinstance(df_result, pd.DataFrame):
+        if output_format == 'csv':
+            rows = _write_csv(df_result, path, chunk_rows)
+        else:
+            schema = pa.Schema.from_pandas(df_result, preserve_index=_keep_index(df_result))
+            rows = _write_batches(_pandas_batches(df_result, schema, chunk_rows), schema, path, output_format)
+    elif output_format == 'csv':
+        # duckdb 原生的写出本身就是流式的
+        df_result.write_csv(str(path))
+        rows = None
+    elif output_format == 'parquet':
+        df_result.write_parquet(str(path))
+        rows = None
+    else:
+        reader = df_result.fetch_record_batch(chunk_rows)
+        rows = _write_batches(reader, reader.schema, path, output_format)
+
+    stats = ExportStats(path=path,
+                        output_format=output_format,
+                        rows=rows,
+                        bytes_written=path.stat().st_size,
+                        seconds=time.perf_counter() - start)
+    return stats
+
+
+_PANDAS_CSV = '''
+export_index = not isinstance(df_result.index, pd.RangeIndex)
+with open(export_path, 'w', encoding='utf-8', newline='') as f:
+    for start in range(0, max(len(df_result), 1), {chunk_rows}):
+        df_result.iloc[start:start + {chunk_rows}].to_csv(f, index=export_index, header=start == 0)
+export_rows = len(df_result)
+'''
+
+_PANDAS_BATCHES = '''
+export_index = not isinstance(df_result.index, pd.RangeIndex)
+export_schema = pa.Schema.from_pandas(df_result, preserve_index=export_index)
+with {writer}(str(export_path), export_schema) as writer:
+    for start in range(0, len(df_result), {chunk_rows}):
+        writer.write_batch(pa.RecordBatch.from_pandas(df_result.iloc[start:start + {chunk_rows}], schema=export_schema,
+                                                      preserve_index=export_index))
+export_rows = len(df_result)
+'''
+
+_DUCKDB_NATIVE = '''
+df_result.{method}(str(export_path))
+export_rows = None
+'''
+
+_DUCKDB_BATCHES = '''
+export_reader = df_result.fetch_record_batch({chunk_rows})
+export_rows = 0
+with pa.ipc.new_file(str(export_path), export_reader.schema) as writer:
+    for batch in export_reader:
+        writer.write_batch(batch)
+        export_rows += batch.num_rows
+'''
+
+_EXPORT_STATS = '''
+export_stats = {{'path': str(export_path), 'output_format': '{output_format}', 'rows': export_rows,
+                'bytes_written': export_path.stat().st_size, 'seconds': time.perf_counter() - export_start}}
+print(f"export {{'?' if export_rows is None else export_rows}} rows to {{export_path}} ({output_format}): "
+      f"{{export_stats['bytes_written'] / 1024 ** 2:.1f}}MB in {{export_stats['seconds']:.3f}}s")
+'''
+
+
+def export_imports(output_format: OutputFormat) -> List[str]:
+    packages = ['import time', 'from pathlib import Path']
+    if output_format != 'csv':
+        packages.append('import pyarrow as pa')
+    if output_format == 'parquet':
+        packages.append('import pyarrow.parquet as pq')
+    return packages
+
+
+def export_code(path: str | Path,
+                output_format: OutputFormat = 'csv',
+                chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                engine: str = 'pandas') -> str:
+    # 生成与 export_frame 相同的分块写出代码，生成的脚本不依赖项目中的模块，可以在任意目录单独运行
+    if output_format == 'csv':
+        pandas_body = _PANDAS_CSV.format(chunk_rows=chunk_rows)
+    else:
+        writer = 'pq.ParquetWriter' if output_format == 'parquet' else 'pa.ipc.new_file'
+        pandas_body = _PANDAS_BATCHES.format(writer=writer, chunk_rows=chunk_rows)
+
+    body = pandas_body.strip('\n')
+    if engine == 'duckdb':
+        # duckdb 原生的写出本身就是流式的，process_data 返回 DataFrame 时按 pandas 的方式写出
+        if output_format == 'arrow':
+            duckdb_body = _DUCKDB_BATCHES.format(chunk_rows=chunk_rows)
+        else:
+            duckdb_body = _DUCKDB_NATIVE.format(method=f'write_{output_format}')
+        body = '\n'.join(['if isinstance(df_result, pd.DataFrame):',
+                          textwrap.indent(body, ' ' * 4),
+                          'else:',
+                          textwrap.indent(duckdb_body.strip('\n'), ' ' * 4)])
+
+    return '\n'.join([f'export_path = Path(r"{Path(path).absolute()}")',
+                      'export_path.parent.mkdir(parents=True, exist_ok=True)',
+                      'export_start = time.perf_counter()',
+                      body,
+                      _EXPORT_STATS.format(output_format=output_format).strip('\n')])
@@ -1,21 +1,28 @@
 import io
-import time
 from pathlib import Path
 from typing import List
 
 import pandas as pd
+import pyarrow.parquet as pq
 import streamlit as st
 from pydantic import BaseModel
 from functools import partial
-import openai
 
 if st.session_state.get('run') is True:
     from utils.config import CACHE_REFORMAT_DATA_PATH, CACHE_REFORMAT_TEMPLATE_PATH, CACHE_REFORMAT_PATH
-    from utils.alignment import RequirementDoc, ColumnField, DataDesc, PlanningDoc
+    from utils.alignment import (
+        RequirementDoc, ColumnField, DataDesc, PlanningDoc, PlanningStreamParser, TableManifest, WorkFlowItem
+    )
 
 else:
     from ..utils.config import CACHE_REFORMAT_DATA_PATH, CACHE_REFORMAT_TEMPLATE_PATH, CACHE_REFORMAT_PATH
-    from ..utils.alignment import RequirementDoc, ColumnField, DataDesc, PlanningDoc
+    from ..utils.alignment import (
+        RequirementDoc, ColumnField, DataDesc, PlanningDoc, PlanningStreamParser, TableManifest, WorkFlowItem
+    )
+
+from llm_cache import completion_cache
+from llm_client import get_client
+from prefetch import prefetcher
 
 PAGE_NAME = 'docs'
 
@@ -39,8 +46,14 @@ class TableInfoOutput(TableInfo):
 
 
 def get_all_tables(dir_path: Path):
+    # 优先使用数据对齐时生成的清单，不需要打开数据文件
+    if (manifest := TableManifest.load(dir_path)) is not None:
+        return [TableInfo(file_name=x.file_name, sheet_name=x.sheet_name, columns=x.columns) for x in manifest.tables]
+
     all_tables = []
     for file in dir_path.iterdir():
+        if file.suffix == '.json':
+            continue
         if file.name.endswith('.xlsx'):
             for sheet in pd.ExcelFile(io.BytesIO(file.read_bytes())).sheet_names:
                 df = pd.read_excel(io.BytesIO(file.read_bytes()), nrows=1, sheet_name=sheet, header=0)
@@ -48,18 +61,38 @@ def get_all_tables(dir_path: Path):
         elif file.name.endswith('.csv'):
             df = pd.read_csv(io.BytesIO(file.read_bytes()), nrows=1, header=0)
             all_tables.append(TableInfo(file_name=file.name, columns=df.columns.tolist()))
+        elif file.name.endswith('.parquet'):
+            all_tables.append(TableInfo(file_name=file.name, columns=pq.read_schema(file).names))
         else:
-            raise Exception('仅支持 csv 和 xlsx 格式')
+            raise Exception('仅支持 csv、xlsx 和 parquet 格式')
 
     return all_tables
 
 
+def to_xlsx_bytes(path: Path, sheet_name: str | None) -> bytes:
+    buffer = io.BytesIO()
+    pd.read_parquet(path).to_excel(buffer, index=False, sheet_name=sheet_name or 'Sheet1')
+    return buffer.getvalue()
+
+
+def download_component(dir_path: Path, table: TableInfo, idx: int):
+    # 只有在用户需要下载时才把 parquet 转换为 xlsx
+    if not table.file_name.endswith('.parquet'):
+        return
+    if st.button('生成 xlsx 文件', key=f'{idx}{dir_path}生成xlsx'):
+        st.download_button('下载 xlsx 文件',
+                           data=to_xlsx_bytes(dir_path / table.file_name, table.sheet_name),
+                           file_name=Path(table.file_name).with_suffix('.xlsx').name,
+                           key=f'{idx}{dir_path}下载xlsx')
+
+
 def data_component(dir_path: Path) -> List[DataDesc]:
     output = []
     for idx, table in enumerate(get_all_tables(dir_path)):
         title = f'{table.file_name}'
         title = title if table.sheet_name is None else f'{title}（sheet：{table.sheet_name}）'
         st.markdown(f'##### {idx + 1}. {title}')
+        download_component(dir_path, table, idx)
 
         st.markdown('- **数据描述**（填写这份数据的描述的内容）')
         table_desc = st.text_input(f'{idx}{dir_path}数据描述', label_visibility='collapsed', max_chars=100)
@@ -70,6 +103,13 @@ def data_component(dir_path: Path) -> List[DataDesc]:
                 '类型': [''] * len(table.columns),
                 '描述': [''] * len(table.columns)}
         df_data = st.data_editor(pd.DataFrame(data), use_container_width=True, hide_index=True)
+
+        # 字段分析在数据对齐完成时已经提交到后台，这里只等待尚未完成的部分
+        with st.spinner('字段分析中...'):
+            profile = prefetcher.profile(dir_path / table.file_name)
+        if profile is not None:
+            with st.expander('字段取值（抽样统计）'):
+                st.text(profile.to_prompt_str())
         st.caption('')
         st.caption('')
 
@@ -93,25 +133,32 @@ def save_doc(content):
         f.write(content)
 
 
-def get_plan(prompt):
+def get_plan(prompt, progress=None):
     st.session_state['plan_string'] = ''
-
-    client = openai.OpenAI(api_key=st.session_state['api_key'],
-                           base_url=st.session_state['base_url'])
-
-    response = client.chat.completions.create(
-        model='gpt-4-1106-preview',
-        temperature=1e-3,
+    parser = PlanningStreamParser()
+    st.session_state['plan_parser'] = parser
+
+    client = get_client(api_key=st.session_state['api_key'],
+                        base_url=st.session_state['base_url'])
+
+    model, temperature, messages = 'gpt-4-1106-preview', 1e-3, [{'role': 'user', 'content': prompt}]
+    response = completion_cache.cached_create(
+        partial(client.chat.completions.create, model=model, temperature=temperature, stream=True, messages=messages),
+        model=model,
+        temperature=temperature,
+        messages=messages,
         stream=True,
-        messages=[{'role': 'user', 'content': prompt}]
+        base_url=st.session_state['base_url']
     )
 
     for x in response:
         if len(x.choices) > 0:
             if (string := x.choices[0].delta.content) is not None:
-                time.sleep(0.1)
                 st.session_state['plan_string'] += string
+                if progress is not None and any(isinstance(i, WorkFlowItem) for i in parser.feed(string)):
+                    progress.caption(f'已解析 {len(parser.items)} 个步骤：{parser.items[-1].title}')
                 yield string
+    parser.close()
 
 
 def run():
@@ -162,10 +209,11 @@ def run():
         with cols[2]:
             st.markdown('### 任务大纲')
             if st.button('生成执行大纲', use_container_width=True):
-                p_get_plan = partial(get_plan, prompt=PlanningDoc.gen_planning_prompt(r))
+                progress = st.empty()
+                p_get_plan = partial(get_plan, prompt=PlanningDoc.gen_planning_prompt(r), progress=progress)
                 try:
                     st.write_stream(p_get_plan)
-                    st.write(PlanningDoc.parse_from_llm_output(st.session_state['plan_string']).model_dump())
+                    st.write(st.session_state['plan_parser'].to_planning_doc().model_dump())
                     st.caption('')
 
                 except Exception as e:
@@ -1,7 +1,6 @@
-import io
+from pathlib import Path
 from typing import Dict, List
 
-import numpy as np
 import pandas as pd
 import streamlit as st
 from pydantic import BaseModel
@@ -13,6 +12,7 @@ if st.session_state.get('run') is True:
     CACHE_UPLOAD_DATA_PATH,
     CACHE_UPLOAD_TEMPLATE_PATH,
 )
+    from utils.alignment import TableManifest, TableManifestItem
 else:
     from ..utils.config import (
         CACHE_REFORMAT_DATA_PATH,
@@ -20,6 +20,11 @@ else:
         CACHE_UPLOAD_DATA_PATH,
         CACHE_UPLOAD_TEMPLATE_PATH
 )
+    from ..utils.alignment import TableManifest, TableManifestItem
+
+from cache import columnar_cache, write_parquet
+from introspect import read_preview
+from prefetch import prefetcher
 
 PAGE_NAME = 'data'
 
@@ -39,26 +44,22 @@ class DataAlignmentConfig(BaseModel):
     select_cols: list[int]
 
 
-def read_data(_file, nrows=20) -> Dict[str | None, pd.DataFrame | Exception]:
+@st.cache_data(show_spinner=False)
+def read_data_by_hash(file_hash: str, path: str, nrows: int) -> Dict[str | None, pd.DataFrame | Exception]:
+    _file = Path(path)
+    # 上传时已经提交了后台任务，只需要等待尚未完成的部分
+    if (preview := prefetcher.preview(_file, nrows)) is not None:
+        return preview
     try:
-        if _file.suffix == '.xlsx':
-            df_read_data = {}
-            for sheet in pd.ExcelFile(io.BytesIO(_file.read_bytes())).sheet_names:
-                df_read_data[sheet] = pd.read_excel(io.BytesIO(_file.read_bytes()), nrows=nrows, sheet_name=sheet,
-                                                    header=None)
-            return df_read_data
-
-        elif _file.suffix == '.csv':
-            df_read_data = pd.read_csv(io.BytesIO(_file.read_bytes()), nrows=nrows, header=None)
-            return {None: df_read_data}
-
-        else:
-            raise Exception('仅支持 csv 和 xlsx 格式')
-
+        return read_preview(_file, nrows)
     except Exception as e:
         return {None: e}
 
 
+def read_data(_file, nrows=20) -> Dict[str | None, pd.DataFrame | Exception]:
+    return read_data_by_hash(columnar_cache.content_hash(_file), str(_file), nrows)
+
+
 def show_single_table(file, df, count, sheet_name, label_prefix) -> DataAlignmentConfig | None:
     st.markdown(f'##### {count}. {file.name}（sheet：{sheet_name}）' if sheet_name else f'##### {file.name}')
 
@@ -166,6 +167,39 @@ def validate_cfg(data_cfg_ls: List[DataAlignmentConfig], template_cfg_ls: List[D
     return True
 
 
+def read_selected_columns(data: DataAlignmentConfig, src_dir: Path) -> pd.DataFrame | None:
+    # 表头行与选择的列直接下推到读取过程，未选择的列不会被解析
+    col_idx = [c - 1 for c in data.select_cols]
+    if data.file_name.endswith('.xlsx'):
+        df = pd.read_excel(src_dir / data.file_name, sheet_name=data.sheet_name, header=data.header - 1,
+                           usecols=col_idx)
+    elif data.file_name.endswith('.csv'):
+        df = pd.read_csv(src_dir / data.file_name, header=data.header - 1, usecols=col_idx)
+    else:
+        return None
+
+    # usecols 按文件中的顺序返回，恢复为选择时的顺序
+    cols_by_idx = dict(zip(sorted(col_idx), df.columns))
+    return df[[cols_by_idx[i] for i in col_idx]]
+
+
+def reformat_table(data: DataAlignmentConfig, src_dir: Path, dst_dir: Path, count: int) -> TableManifestItem | None:
+    if (df := read_selected_columns(data, src_dir)) is None:
+        return None
+
+    # 对齐后的数据以 parquet 存储，需要下载时再转换为 xlsx
+    dst = dst_dir / f'数据{count}.parquet'
+    write_parquet(df, dst)
+
+    # 写入时已经知道表头信息，记录到清单中，文档页面不需要再次读取数据文件
+    return TableManifestItem(file_name=dst.name,
+                             sheet_name=data.sheet_name,
+                             columns=[str(c) for c in df.columns],
+                             dtypes=[str(t) for t in df.dtypes],
+                             rows=len(df),
+                             content_hash=columnar_cache.content_hash(dst))
+
+
 def create_file_for_docs(data_cfg_ls: List[DataAlignmentConfig], template_cfg_ls: List[DataAlignmentConfig]):
     for file in REFORMAT_DATA_DIR.glob('*'):
         file.unlink()
@@ -174,33 +208,16 @@ def create_file_for_docs(data_cfg_ls: List[DataAlignmentConfig], template_cfg_ls
         file.unlink()
 
     count = 0
-    for data in data_cfg_ls:
-        if data.file_name.endswith('.xlsx'):
-            df = pd.read_excel(UPLOAD_DATA_DIR / data.file_name, sheet_name=data.sheet_name, header=data.header - 1)
-            col_idx = np.array(data.select_cols) - 1
-            df = df[df.columns[col_idx]]
-            df.to_excel(REFORMAT_DATA_DIR / f'数据{count}.xlsx', index=False, sheet_name=data.sheet_name)
-
-        elif data.file_name.endswith('.csv'):
-            df = pd.read_csv(UPLOAD_DATA_DIR / data.file_name, header=data.header - 1)
-            col_idx = np.array(data.select_cols) - 1
-            df = df[df.columns[col_idx]]
-            df.to_csv(REFORMAT_DATA_DIR / f'数据{count}.csv', index=False)
-        count += 1
-
-    for data in template_cfg_ls:
-        if data.file_name.endswith('.xlsx'):
-            df = pd.read_excel(UPLOAD_TEMPLATE_DIR / data.file_name, sheet_name=data.sheet_name, header=data.header - 1)
-            col_idx = np.array(data.select_cols) - 1
-            df = df[df.columns[col_idx]]
-            df.to_excel(REFORMAT_TEMPLATE_DIR / f'数据{count}.xlsx', index=False, sheet_name=data.sheet_name)
-
-        elif data.file_name.endswith('.csv'):
-            df = pd.read_csv(UPLOAD_TEMPLATE_DIR / data.file_name, header=data.header - 1)
-            col_idx = np.array(data.select_cols) - 1
-            df = df[df.columns[col_idx]]
-            df.to_csv(REFORMAT_TEMPLATE_DIR / f'数据{count}.csv', index=False)
-        count += 1
+    for cfg_ls, src_dir, dst_dir in [(data_cfg_ls, UPLOAD_DATA_DIR, REFORMAT_DATA_DIR),
+                                     (template_cfg_ls, UPLOAD_TEMPLATE_DIR, REFORMAT_TEMPLATE_DIR)]:
+        manifest = TableManifest()
+        for data in cfg_ls:
+            if (item := reformat_table(data, src_dir, dst_dir, count)) is not None:
+                manifest.tables.append(item)
+                # 文档页面展示的字段取值在后台分析
+                prefetcher.submit_profile(dst_dir / item.file_name)
+            count += 1
+        manifest.save(dst_dir)
 
 
 def run():
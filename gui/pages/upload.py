@@ -1,5 +1,7 @@
-import copy
+import hashlib
 import io
+import uuid
+from pathlib import Path
 
 import pandas as pd
 import streamlit as st
@@ -9,38 +11,89 @@ if st.session_state.get('run') is True:
 else:
     from ..utils.config import CACHE_UPLOAD_DATA_PATH, CACHE_UPLOAD_TEMPLATE_PATH
 
+from cache import columnar_cache
+from prefetch import prefetcher
+
 PAGE_NAME = 'upload'
 
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+SNIFF_BYTES = 64 * 1024
+SNIFF_ROWS = 20
+XLSX_MAGIC = b'PK\x03\x04'
+
 UPLOAD_DATA_DIR = CACHE_UPLOAD_DATA_PATH
 CACHE_UPLOAD_TEMPLATE_PATH = CACHE_UPLOAD_TEMPLATE_PATH
 
 st.set_page_config(layout='wide')
 
 
+def save_file(file, dst_dir: Path) -> Path | None:
+    # 分块写入临时文件并同时计算哈希，与已有文件内容相同时不再重复保存
+    file.seek(0)
+    digest = hashlib.sha256()
+    tmp = dst_dir.parent / f'{uuid.uuid4().hex}.uploading'
+    with open(tmp, 'wb') as f:
+        while chunk := file.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+    file.seek(0)
+
+    digest = digest.hexdigest()
+    for exist in dst_dir.iterdir():
+        if columnar_cache.content_hash(exist) == digest:
+            tmp.unlink()
+            return None
+
+    dst = dst_dir / file.name
+    tmp.replace(dst)
+    columnar_cache.remember_hash(dst, digest)
+    return dst
+
+
 def save_files(data_files=None, template_file=None):
     if data_files is not None:
         for file in data_files:
-            with open(UPLOAD_DATA_DIR / file.name, 'wb') as f:
-                f.write(file.read())
+            save_file(file, UPLOAD_DATA_DIR)
 
     if template_file is not None:
-        with open(CACHE_UPLOAD_TEMPLATE_PATH / template_file.name, 'wb') as f:
-            f.write(template_file.read())
+        save_file(template_file, CACHE_UPLOAD_TEMPLATE_PATH)
+
+    # 用户进入下一步之前，在后台读取预览；字段分析依赖用户选择的工作表与表头，在数据对齐后进行
+    for file in [*UPLOAD_DATA_DIR.iterdir(), *CACHE_UPLOAD_TEMPLATE_PATH.iterdir()]:
+        prefetcher.submit(file)
 
 
 @st.cache_data(show_spinner=False)
 def check_file(file):
+    # 只检查文件格式、表头以及少量样本行，不解析完整文件
     try:
+        file.seek(0)
         if file.name.endswith('.xlsx'):
-            pd.read_excel(io.BytesIO(copy.deepcopy(file).read()))
+            import openpyxl
+
+            if file.read(len(XLSX_MAGIC)) != XLSX_MAGIC:
+                raise Exception('不是有效的 xlsx 文件')
+            file.seek(0)
+            wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+            try:
+                for ws in wb.worksheets:
+                    list(ws.iter_rows(max_row=SNIFF_ROWS, values_only=True))
+            finally:
+                wb.close()
             return
         elif file.name.endswith('.csv'):
-            pd.read_csv(io.BytesIO(copy.deepcopy(file).read()))
+            sample = file.read(SNIFF_BYTES)
+            if len(sample) == SNIFF_BYTES:
+                # 截断到最后一个完整行，避免样本末尾出现半行数据
+                sample = sample[:sample.rfind(b'\n') + 1] or sample
+            pd.read_csv(io.BytesIO(sample), nrows=SNIFF_ROWS)
             return
         else:
             raise Exception('仅支持 csv 和 xlsx 格式')
     except Exception as e:
         return e
+    finally:
+        file.seek(0)
 
 
 def upload_data_files_component():
@@ -58,7 +111,7 @@ def upload_data_files_component():
     validate_files_ls = []
     for file in check_files_ls:
         with st.spinner(f'《{file.name}》解析中...'):
-            if err := check_file(file) is None:
+            if (err := check_file(file)) is None:
                 validate_files_ls.append(file)
                 st.success(f'《{file.name}》解析成功')
             elif isinstance(err, Exception):
@@ -73,7 +126,7 @@ def upload_template_file_component():
 
     validate_template_file = None
     if result_template:
-        if err := check_file(result_template) is None:
+        if (err := check_file(result_template)) is None:
             validate_template_file = result_template
             st.success('结果模板解析成功')
         else:
@@ -1,5 +1,6 @@
 import re
-from typing import List
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
 
 import markdown_to_json
 from pydantic import BaseModel, Field
@@ -69,6 +70,32 @@ GEN_PLANNING_TMPL = """
 """
 
 
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+class TableManifestItem(BaseModel):
+    file_name: str = Field(description='对齐后的文件名称')
+    sheet_name: str | None = Field(None, description='sheet名称')
+    columns: List[str] = Field(default_factory=list, description='字段名称')
+    dtypes: List[str] = Field(default_factory=list, description='字段类型')
+    rows: int = Field(0, description='数据行数')
+    content_hash: str = Field('', description='文件内容哈希')
+
+
+class TableManifest(BaseModel):
+    tables: List[TableManifestItem] = Field(default_factory=list, description='对齐后的表格信息')
+
+    def save(self, dir_path: Path):
+        (dir_path / MANIFEST_FILE_NAME).write_text(self.model_dump_json(indent=2), encoding='utf-8')
+
+    @classmethod
+    def load(cls, dir_path: Path) -> 'TableManifest | None':
+        path = dir_path / MANIFEST_FILE_NAME
+        if not path.exists():
+            return None
+        return cls.model_validate_json(path.read_text(encoding='utf-8'))
+
+
 class ColumnField(BaseModel):
     name: str = Field(description='字段名称')
     type: str = Field(None, description='字段类型')
@@ -104,6 +131,16 @@ class DataDesc(BaseModel):
                 f"{INDENT_4}- 数据内容：{self.data_desc}\n"
                 f"{INDENT_4}- 关键字段：{key_field_string}\n")
 
+    def column_types(self) -> Dict[str, str]:
+        # 表格编辑器中未填写的类型为空字符串
+        return {x.name: x.type.strip() for x in self.column_fields if x.type and x.type.strip() not in ('None', 'nan')}
+
+    def to_dataframe_info(self, dir_path: Path):
+        # 字段声明的类型用于生成指定类型的读取代码；延迟导入，页面已经将项目路径加入 sys.path
+        from schema import DataFrameInfo
+        return DataFrameInfo(name=Path(self.file_name).stem, path=dir_path / self.file_name,
+                             column_types=self.column_types())
+
 
 class RequirementDoc(BaseModel):
     task_title: str = Field(description='任务标题')
@@ -145,6 +182,14 @@ class RequirementDoc(BaseModel):
                 f"## 数据逻辑\n"
                 f"{process_logic_string}\n")
 
+    def to_query_prompt(self, dir_path: Path, plan: 'PlanningDoc' = None, **kwargs):
+        # 由需求文档与执行大纲生成代码生成所需的 QueryPrompt，其余参数原样传入
+        from schema import QueryPrompt
+        return QueryPrompt(dfs=[x.to_dataframe_info(dir_path) for x in self.input_data],
+                           query=self.to_description(),
+                           plan='' if plan is None else plan.to_plan_text(),
+                           **kwargs)
+
 
 class OperatorDesc(BaseModel):
     title: str = Field(description='当前操作的标题名称')
@@ -161,6 +206,18 @@ class WorkFlowItem(BaseModel):
 class PlanningDoc(BaseModel):
     item: List[WorkFlowItem] = Field(description='操作计划的内容')
 
+    def to_plan_text(self) -> str:
+        # 作为 QueryPrompt.plan，处理步骤中出现的字段在裁剪读取字段时会被保留
+        lines = []
+        for flow in self.item:
+            lines.append(f'# {flow.title}')
+            for op in flow.operators:
+                lines.append(f'## {op.title}')
+                lines.append(f'- 输入：{op.input}')
+                lines.append(f'- 输出：{op.output}')
+                lines.extend(f'- {x}' for x in op.operation)
+        return '\n'.join(lines)
+
     @classmethod
     def to_import_data_head(cls, r: RequirementDoc):
         total_input_data = '\n'.join([f'- {x.file_name}' for x in r.input_data])
@@ -207,6 +264,94 @@ class PlanningDoc(BaseModel):
 
         return cls(item=work_flow_items)
 
+class PlanningStreamParser:
+    # 增量解析模型流式输出的大纲，每个二级标题块结束时产出 OperatorDesc，一级标题块结束时产出 WorkFlowItem
+
+    def __init__(self):
+        self.buffer = ''
+        self.in_markdown = False
+        self.items: List[WorkFlowItem] = []
+        self._flow_title: str | None = None
+        self._operators: List[OperatorDesc] = []
+        self._op_title: str | None = None
+        self._op_sections: dict = {}
+        self._section: str | None = None
+
+    def feed(self, chunk: str) -> List[OperatorDesc | WorkFlowItem]:
+        self.buffer += chunk
+        *lines, self.buffer = self.buffer.split('\n')
+        result = []
+        for line in lines:
+            result.extend(self._feed_line(line))
+        return result
+
+    def close(self) -> List[OperatorDesc | WorkFlowItem]:
+        result = self._feed_line(self.buffer) if self.buffer else []
+        self.buffer = ''
+        return result + self._close_flow()
+
+    def parse_stream(self, chunks: Iterable[str]) -> Iterator[OperatorDesc | WorkFlowItem]:
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.close()
+
+    def _feed_line(self, line: str) -> List[OperatorDesc | WorkFlowItem]:
+        stripped = line.strip()
+        if not self.in_markdown:
+            self.in_markdown = stripped.startswith('```markdown')
+            return []
+        if stripped.startswith('```'):
+            self.in_markdown = False
+            return self._close_flow()
+
+        if re.match(r'^#\s', stripped):
+            result = self._close_flow()
+            self._flow_title = stripped[1:].strip()
+            return result
+        if re.match(r'^##\s', stripped):
+            result = self._close_operator()
+            self._op_title = stripped[2:].strip()
+            return result
+        if re.match(r'^###\s', stripped):
+            self._section = stripped[3:].strip()
+            self._op_sections[self._section] = []
+            return []
+
+        if stripped and self._section is not None:
+            self._op_sections[self._section].append(re.sub(r'^[-*+]\s+', '', stripped))
+        return []
+
+    def _close_operator(self) -> List[OperatorDesc]:
+        if self._op_title is None:
+            return []
+
+        op_input, op_output, op = '', '', []
+        for key, values in self._op_sections.items():
+            if '输入' in key:
+                op_input = '，'.join(values)
+            elif '输出' in key:
+                op_output = '，'.join(values)
+            elif '操作' in key:
+                op = values
+
+        operator = OperatorDesc(title=self._op_title, input=op_input, output=op_output, operation=op)
+        self._operators.append(operator)
+        self._op_title, self._op_sections, self._section = None, {}, None
+        return [operator]
+
+    def _close_flow(self) -> List[OperatorDesc | WorkFlowItem]:
+        result = self._close_operator()
+        if self._flow_title is None:
+            return result
+
+        item = WorkFlowItem(title=self._flow_title, operators=self._operators)
+        self.items.append(item)
+        self._flow_title, self._operators = None, []
+        return result + [item]
+
+    def to_planning_doc(self) -> PlanningDoc:
+        return PlanningDoc(item=self.items)
+
 # r = RequirementDoc(
 #     task_desc='通过读取并处理品智平台数据与美团外卖订单及账单数据，实现对账结果的汇总、'
 #               '差异标注，并将处理后的数据保存为对账结果表。',
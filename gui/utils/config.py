@@ -1,5 +1,12 @@
+import sys
 from pathlib import Path
 
+PROJECT_PATH = Path(__file__).absolute().parents[2]
+
+# 项目根目录追加到末尾，页面可以导入根目录下的模块，同时不覆盖 gui 下的 utils 包
+if str(PROJECT_PATH) not in sys.path:
+    sys.path.append(str(PROJECT_PATH))
+
 CURRENT_PATH = Path().absolute()
 CACHE_PATH = CURRENT_PATH / '.cache'
 CACHE_UPLOAD_PATH = CACHE_PATH / 'upload_data'
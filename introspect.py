@@ -0,0 +1,263 @@
+import datetime
+import io
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pydantic import BaseModel, Field
+
+CSV_CHUNK_SIZE = 100_000
+# 各类单元格取值的示例，用于得到当前 pandas 版本推断的类型
+EXCEL_SAMPLES = {'bool': True, 'int64': 1, 'float64': 1.5, 'datetime': datetime.datetime(2000, 1, 1), 'str': 'a'}
+
+
+class ColumnSchema(BaseModel):
+    name: str = Field(description='字段名称')
+    dtype: str = Field(description='推断的 pandas 类型')
+    non_null: int = Field(0, description='非空值数量')
+
+
+def _format_table(headers: List[str], rows: List[List[str]]) -> List[str]:
+    widths = [max(len(r[i]) for r in [headers] + rows) for i in range(len(headers))]
+    widths[0] = max(widths[0], 3)
+    lines = ['  '.join(h.ljust(w) for h, w in zip(headers, widths)),
+             '  '.join(('---' if i == 0 else '-' * len(h)).ljust(w) for i, (h, w) in enumerate(zip(headers, widths)))]
+    lines += ['  '.join(v.ljust(w) for v, w in zip(r, widths)) for r in rows]
+    return lines
+
+
+class TableSchema(BaseModel):
+    rows: int = Field(0, description='数据行数')
+    columns: List[ColumnSchema] = Field(default_factory=list, description='字段信息')
+
+    def to_info_str(self) -> str:
+        # 与 df.info() 的输出格式保持一致（不包含内存占用）
+        index_line = (f'RangeIndex: {self.rows} entries, 0 to {self.rows - 1}'
+                      if self.rows > 0 else 'RangeIndex: 0 entries')
+        lines = ["<class 'pandas.core.frame.DataFrame'>",
+                 index_line,
+                 f'Data columns (total {len(self.columns)} columns):']
+
+        headers = [' #', 'Column', 'Non-Null Count', 'Dtype']
+        lines += _format_table(headers, [[f' {i}', c.name, f'{c.non_null} non-null', c.dtype]
+                                         for i, c in enumerate(self.columns)])
+
+        counts = Counter(c.dtype for c in self.columns)
+        lines.append('dtypes: ' + ', '.join(f'{k}({v})' for k, v in sorted(counts.items())))
+        return '\n'.join(lines) + '\n'
+
+    def to_relation_str(self) -> str:
+        # DuckDB 关系对象的字段名称与类型（relation.columns / relation.types），附带非空值数量
+        lines = [f'duckdb.DuckDBPyRelation: {self.rows} rows, {len(self.columns)} columns']
+        headers = [' #', 'Column', 'Type', 'Non-Null Count']
+        lines += _format_table(headers, [[f' {i}', c.name, c.dtype, f'{c.non_null} non-null']
+                                         for i, c in enumerate(self.columns)])
+        return '\n'.join(lines) + '\n'
+
+    def select(self, columns: List[str] = None, dtypes: Dict[str, str] = None) -> 'TableSchema':
+        # 只保留实际读取的字段，类型使用读取代码中指定的类型
+        dtypes = dtypes or {}
+        return TableSchema(rows=self.rows,
+                           columns=[c.model_copy(update={'dtype': dtypes.get(c.name, c.dtype)})
+                                    for c in self.columns if columns is None or c.name in columns])
+
+
+def _dedupe_columns(names: Iterable) -> List[str]:
+    # 与 pandas 读取时的列名处理方式一致：空列名为 Unnamed: i，重复列名追加 .n
+    result, seen = [], Counter()
+    for i, name in enumerate(names):
+        name = f'Unnamed: {i}' if name is None or (isinstance(name, str) and not name.strip()) else str(name)
+        origin = name
+        while name in result:
+            seen[origin] += 1
+            name = f'{origin}.{seen[origin]}'
+        result.append(name)
+    return result
+
+
+def _merge_dtype(a: str | None, b: str) -> str:
+    if a is None or a == b:
+        return b
+    if {a, b} <= {'int64', 'float64'}:
+        return 'float64'
+    return 'object'
+
+
+@lru_cache(maxsize=1)
+def _csv_null_dtypes() -> Dict[str, str]:
+    # 整数、布尔列出现空值时 read_csv 推断的类型
+    df = pd.read_csv(io.StringIO('i,b\n1,True\n,\n'))
+    return {'int64': str(df['i'].dtype), 'bool': str(df['b'].dtype)}
+
+
+@lru_cache(maxsize=1)
+def _excel_dtypes() -> Dict[Tuple[str | None, bool], str]:
+    # read_excel 把单元格的取值交给 TextParser 推断类型，用同样的方式得到当前 pandas 版本下的类型，
+    # 例如 pandas 3 中字符串为 str、日期为 datetime64[us]，含空值的布尔列为 float64
+    from pandas.io.parsers import TextParser
+
+    columns = {(None, True): [None, None]}
+    for kind, value in EXCEL_SAMPLES.items():
+        columns[(kind, False)] = [value, value]
+        columns[(kind, True)] = [value, None]
+    keys = list(columns)
+    rows = [[str(i) for i in range(len(keys))]] + [[columns[k][j] for k in keys] for j in range(2)]
+    df = TextParser(rows, header=0).read()
+    return {k: str(df[str(i)].dtype) for i, k in enumerate(keys)}
+
+
+def _excel_value_kind(value) -> str:
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int64'
+    if isinstance(value, float):
+        return 'float64'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return 'datetime'
+    if isinstance(value, str):
+        return 'str'
+    return 'object'
+
+
+def _excel_column_dtype(kinds: set, non_null: int, rows: int) -> str:
+    dtypes, has_null = _excel_dtypes(), non_null < rows
+    if not kinds:
+        return dtypes[(None, True)]
+    if len(kinds) == 1:
+        return dtypes.get((next(iter(kinds)), has_null), 'object')
+    if kinds <= {'int64', 'float64'}:
+        return dtypes[('float64', has_null)]
+    return 'object'
+
+
+def scan_excel(path: Path, sheet_name: str | int = 0) -> TableSchema:
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[sheet_name] if isinstance(sheet_name, int) else wb[sheet_name]
+        rows_iter = ws.iter_rows(values_only=True)
+        header = next(rows_iter, None)
+        if header is None:
+            return TableSchema()
+
+        non_null = [0] * len(header)
+        kinds = [set() for _ in header]
+        rows, pending_empty = 0, 0
+        for row in rows_iter:
+            values = [None if isinstance(v, str) and v == '' else v for v in row[:len(header)]]
+            if all(v is None for v in values):
+                # 末尾的空行不计入行数，与 pandas 保持一致
+                pending_empty += 1
+                continue
+            rows += pending_empty + 1
+            pending_empty = 0
+            for i, v in enumerate(values):
+                if v is not None:
+                    non_null[i] += 1
+                    kinds[i].add(_excel_value_kind(v))
+    finally:
+        wb.close()
+
+    # 工作表的尺寸可能比数据更宽，只保留到最右侧有表头或数据的字段，与 pandas 保持一致
+    width = max((i + 1 for i, name in enumerate(header)
+                 if non_null[i] or not (name is None or isinstance(name, str) and not name.strip())), default=0)
+    names = _dedupe_columns(header[:width])
+    columns = [ColumnSchema(name=n, dtype=_excel_column_dtype(k, c, rows), non_null=c)
+               for n, k, c in zip(names, kinds, non_null)]
+    return TableSchema(rows=rows, columns=columns)
+
+
+def scan_csv(path: Path, chunksize: int = CSV_CHUNK_SIZE) -> TableSchema:
+    names, dtypes, non_null, rows = None, None, None, 0
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        if names is None:
+            names = [str(c) for c in chunk.columns]
+            dtypes = [None] * len(names)
+            non_null = [0] * len(names)
+            # 整列为空时使用 pandas 对第一块推断的类型
+            empty_dtypes = [str(chunk[col].dtype) for col in chunk.columns]
+        rows += len(chunk)
+        counts = chunk.notna().sum()
+        for i, col in enumerate(chunk.columns):
+            non_null[i] += int(counts.iloc[i])
+            # 整块为空的列被推断为 float64，不参与合并，否则稀疏的字符串列会被合并为 object
+            if counts.iloc[i]:
+                dtypes[i] = _merge_dtype(dtypes[i], str(chunk[col].dtype))
+
+    if names is None:
+        return TableSchema()
+    # 其他块中的空值会改变整数、布尔列的类型
+    null_dtypes = _csv_null_dtypes()
+    dtypes = [e if d is None else null_dtypes.get(d, d) if c < rows else d
+              for d, e, c in zip(dtypes, empty_dtypes, non_null)]
+    columns = [ColumnSchema(name=n, dtype=d, non_null=c) for n, d, c in zip(names, dtypes, non_null)]
+    return TableSchema(rows=rows, columns=columns)
+
+
+def read_excel_previews(path: Path, nrows: int) -> Dict[str, pd.DataFrame]:
+    import openpyxl
+
+    # 只打开一次工作簿，每个 sheet 只读取前 nrows 行
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        df_read_data = {}
+        for ws in wb.worksheets:
+            rows = list(ws.iter_rows(max_row=nrows, values_only=True))
+            # 工作表的尺寸可能比数据更大，去掉末尾的空行，与 pd.read_excel 保持一致
+            while rows and all(v is None for v in rows[-1]):
+                rows.pop()
+            width = max((i + 1 for row in rows for i, v in enumerate(row) if v is not None), default=0)
+            df_read_data[ws.title] = pd.DataFrame([list(row[:width]) for row in rows])
+        return df_read_data
+    finally:
+        wb.close()
+
+
+def read_preview(path: Path, nrows: int) -> Dict[str | None, pd.DataFrame]:
+    # 不解析表头的前 nrows 行，用于页面上选择表头行与字段，csv 没有 sheet 以 None 为键
+    if path.suffix == '.xlsx':
+        return read_excel_previews(path, nrows)
+    if path.suffix == '.csv':
+        return {None: pd.read_csv(path, nrows=nrows, header=None)}
+    raise Exception('仅支持 csv 和 xlsx 格式')
+
+
+def scan_parquet(path: Path) -> TableSchema:
+    # 类型由 arrow schema 转换得到，非空值数量优先使用行组的统计信息，没有统计信息的字段才读取该列
+    f = pq.ParquetFile(path)
+    meta = f.metadata
+    dtypes = f.schema_arrow.empty_table().to_pandas().dtypes
+    columns = []
+    for i, name in enumerate(f.schema_arrow.names):
+        stats = [meta.row_group(g).column(i).statistics for g in range(meta.num_row_groups)]
+        if all(s is not None and s.has_null_count for s in stats):
+            non_null = meta.num_rows - sum(s.null_count for s in stats)
+        else:
+            column = f.read(columns=[name]).column(0)
+            non_null = len(column) - column.null_count
+        columns.append(ColumnSchema(name=name, dtype=str(dtypes.iloc[i]), non_null=non_null))
+    return TableSchema(rows=meta.num_rows, columns=columns)
+
+
+def scan_table(path: Path) -> TableSchema:
+    suffix = path.suffix
+    if suffix == '.xlsx':
+        return scan_excel(path)
+    if suffix == '.csv':
+        return scan_csv(path)
+    if suffix == '.parquet':
+        return scan_parquet(path)
+    raise Exception('not found')
+
+
+@lru_cache(maxsize=256)
+def count_distinct(parquet_path: Path, columns: Tuple[str, ...]) -> Dict[str, int]:
+    # parquet 缓存文件以内容哈希命名，同一个路径的结果不会变化，只读取需要的列
+    table = pq.read_table(parquet_path, columns=list(columns))
+    return {name: pc.count_distinct(table[name]).as_py() for name in columns}
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterator, List
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+DEFAULT_CACHE_DIR = Path().absolute() / '.cache' / 'llm'
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+
+
+class CacheStats(BaseModel):
+    hits: int = Field(0, description='命中次数')
+    misses: int = Field(0, description='未命中次数')
+    evictions: int = Field(0, description='淘汰的缓存条目数量')
+
+
+# 以 (接口地址, 模型, 温度, 消息, 输出结构) 为键，将模型返回结果持久化到磁盘，支持过期时间与容量上限
+class CompletionCache:
+
+    def __init__(self,
+                 cache_dir: Path = DEFAULT_CACHE_DIR,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, temperature: float, messages: List[Dict], stream: bool = False,
+                 response_model=None, base_url: str = None) -> str:
+        # 不同接口地址下同名模型的返回结果不同，未指定时与 get_client 一致使用环境变量中的地址
+        base_url = str(base_url or os.getenv('BASE_URL') or '')
+        schema = response_model.model_json_schema() if response_model is not None else None
+        raw = json.dumps({'base_url': base_url, 'model': model, 'temperature': temperature, 'messages': messages,
+                          'stream': stream, 'schema': schema},
+                         sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.json'
+
+    def get(self, key: str) -> Dict | None:
+        path = self._path(key)
+        with self._lock:
+            if not path.exists():
+                self.stats.misses += 1
+                return None
+
+            payload = json.loads(path.read_text(encoding='utf-8'))
+            if time.time() - payload['created_at'] > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                self.stats.misses += 1
+                return None
+
+            os.utime(path)
+            self.stats.hits += 1
+            return payload
+
+    def set(self, key: str, kind: str, data):
+        path = self._path(key)
+        payload = {'created_at': time.time(), 'kind': kind, 'data': data}
+        with self._lock:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(payload, ensure_ascii=False), encoding='utf-8')
+            tmp.replace(path)
+            self._evict(keep=path)
+
+    def _evict(self, keep: Path):
+        files = sorted(self.cache_dir.glob('*.json'), key=lambda x: x.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        for f in files:
+            if total <= self.max_bytes:
+                break
+            if f == keep:
+                continue
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+            self.stats.evictions += 1
+
+    def _record_stream(self, key: str, stream) -> Iterator:
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk.model_dump(mode='json'))
+            yield chunk
+        # 只有完整消费的流才写入缓存
+        self.set(key, 'stream', chunks)
+
+    @staticmethod
+    def _decode(payload: Dict, response_model=None):
+        from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+        if payload['kind'] == 'stream':
+            return iter([ChatCompletionChunk.model_validate(x) for x in payload['data']])
+        if payload['kind'] == 'model':
+            return response_model.model_validate(payload['data'])
+        return ChatCompletion.model_validate(payload['data'])
+
+    def _store(self, key: str, result, response_model=None):
+        self.set(key, 'model' if response_model is not None else 'completion', result.model_dump(mode='json'))
+
+    def cached_create(self,
+                      create: Callable,
+                      model: str,
+                      temperature: float,
+                      messages: List[Dict],
+                      stream: bool = False,
+                      response_model=None,
+                      base_url: str = None):
+        if stream and response_model is not None:
+            # instructor 的部分结构流无法回放，直接请求
+            return create()
+
+        key = self.make_key(model, temperature, messages, stream, response_model, base_url)
+        payload = self.get(key)
+        if payload is not None:
+            logger.info(f'llm cache hit: {key}')
+            return self._decode(payload, response_model)
+
+        result = create()
+        if stream:
+            return self._record_stream(key, result)
+        self._store(key, result, response_model)
+        return result
+
+    async def acached_create(self,
+                             create: Callable[[], Awaitable],
+                             model: str,
+                             temperature: float,
+                             messages: List[Dict],
+                             response_model=None,
+                             base_url: str = None):
+        key = self.make_key(model, temperature, messages, False, response_model, base_url)
+        payload = self.get(key)
+        if payload is not None:
+            logger.info(f'llm cache hit: {key}')
+            return self._decode(payload, response_model)
+
+        result = await create()
+        self._store(key, result, response_model)
+        return result
+
+
+completion_cache = CompletionCache()
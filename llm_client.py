@@ -0,0 +1,80 @@
+import asyncio
+import os
+import threading
+from typing import Dict, Tuple
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 10
+DEFAULT_MAX_CONCURRENCY = 8
+
+_clients: Dict[Tuple[str, str], OpenAI] = {}
+# 异步客户端按事件循环分别缓存，事件循环关闭后清除
+_async_clients: Dict[asyncio.AbstractEventLoop, Dict[Tuple[str, str], 'AsyncLLMClient']] = {}
+_lock = threading.Lock()
+
+
+def _client_key(base_url: str = None, api_key: str = None) -> Tuple[str, str]:
+    return base_url or os.getenv('BASE_URL'), api_key or os.getenv('API_KEY')
+
+
+def _limits(max_connections: int, max_keepalive_connections: int) -> httpx.Limits:
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+
+
+def get_client(base_url: str = None,
+               api_key: str = None,
+               max_connections: int = DEFAULT_MAX_CONNECTIONS,
+               max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS) -> OpenAI:
+    # 同一个 (base_url, api_key) 复用同一个客户端，保持 http 长连接，避免每次请求重新握手
+    key = _client_key(base_url, api_key)
+    with _lock:
+        if key not in _clients:
+            http_client = httpx.Client(limits=_limits(max_connections, max_keepalive_connections))
+            _clients[key] = OpenAI(base_url=key[0], api_key=key[1], http_client=http_client)
+        return _clients[key]
+
+
+class AsyncLLMClient:
+    # 异步客户端，通过信号量限制同时进行的请求数量，避免并发请求耗尽连接
+    # 底层连接与信号量绑定首次使用时的事件循环，应通过 get_async_client 按事件循环获取
+
+    def __init__(self,
+                 base_url: str = None,
+                 api_key: str = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS):
+        http_client = httpx.AsyncClient(limits=_limits(max_connections, max_keepalive_connections))
+        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def create(self, response_model=None, **kwargs):
+        async with self.semaphore:
+            if response_model is None:
+                return await self.client.chat.completions.create(**kwargs)
+
+            import instructor
+            return await instructor.from_openai(self.client).chat.completions.create(response_model=response_model,
+                                                                                     **kwargs)
+
+
+def get_async_client(base_url: str = None,
+                     api_key: str = None,
+                     max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                     max_connections: int = DEFAULT_MAX_CONNECTIONS) -> AsyncLLMClient:
+    # 每次 asyncio.run 都会创建新的事件循环，需要在事件循环内调用，不同事件循环使用各自的客户端
+    key = _client_key(base_url, api_key)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        for closed in [x for x in _async_clients if x.is_closed()]:
+            del _async_clients[closed]
+        clients = _async_clients.setdefault(loop, {})
+        if key not in clients:
+            clients[key] = AsyncLLMClient(base_url=key[0],
+                                          api_key=key[1],
+                                          max_concurrency=max_concurrency,
+                                          max_connections=max_connections)
+        return clients[key]
@@ -2,7 +2,9 @@ from pathlib import Path
 
 from loguru import logger
 
+from cache import execution_cache
 from pyrunner import InteractivePythonRunner
+from repair import run_with_repair
 from schema import DataFrameInfo, QueryPrompt
 from utils import call_openai_llm, extract_code
 
@@ -19,7 +21,8 @@ if __name__ == '__main__':
     dfs_info = [DataFrameInfo(name='货品报表', path=Path('./inputs/货品报表_1713510378313.xlsx')),
                 DataFrameInfo(name='库存报表', path=Path('./inputs/库存报表_1713509874777.xlsx'))]
 
-    p = QueryPrompt(dfs=dfs_info, query=query)
+    # 提问要求输出《货品报表》的全部字段，按字段名称裁剪会丢失没有写出名称的字段，这里不裁剪
+    p = QueryPrompt(dfs=dfs_info, query=query, data_format='arrow', typed_readers=True)
     logger.info(p.generate_prompt())
 
     # 模型请求
@@ -30,22 +33,36 @@ if __name__ == '__main__':
 
     ipy_dir = Path('/Users/lzx/miniconda3/envs/py310/bin')
 
-    with InteractivePythonRunner(ipy_dir) as ipy:
-        out, err = ipy.run([p.import_package(),
-                            p.read_pd_data(),
-                            define_function_code,
-                            p.exec_function(),
-                            p.export_result(),
-                            ])
+    cells = p.code_cells(define_function_code)
+    execution_key = p.execution_key(define_function_code)
+
+    # 相同代码与相同输入文件已经执行成功过，直接使用缓存的结果
+    if (cached := execution_cache.get(execution_key, p.file_name)) is not None:
+        out, err = cached
+        cells = execution_cache.cells(execution_key) or cells
+    else:
+        with InteractivePythonRunner(ipy_dir) as ipy:
+            result = run_with_repair(ipy, p, messages, completion, profile=True)
+            out, err = result.out, result.err
+            for attempt in result.attempts:
+                logger.info(f'attempt {attempt.attempt}: llm={attempt.llm_seconds:.3f}s exec={attempt.exec_seconds:.3f}s')
+                for record in attempt.cells:
+                    logger.info(f'cell {record.index}: wall={record.wall_seconds:.3f}s cpu={record.cpu_seconds:.3f}s '
+                                f'mem={record.memory_delta_bytes / 1024 ** 2:+.1f}MB success={record.success}')
+                    for h in record.hotspots:
+                        logger.info(f'  {h.fraction:6.1%} {h.function} ({h.filename}:{h.lineno})'
+                                    + (f' -> {h.leaf}' if h.leaf else ''))
         if err is None:
-            logger.info('success to run code')
-            with open('./outputs/code.py', 'w') as f:
-                total_code = '\n'.join([p.import_package(),
-                                        p.read_pd_data(),
-                                        define_function_code,
-                                        p.exec_function(),
-                                        p.export_result()])
-                f.write(total_code)
-        else:
-            logger.error('error to run code')
-            logger.error(err)
+            # 修复后的代码作为完整代码保存；模型缓存每次返回相同的首次回复，结果同时以首次代码的键保存，重新运行时直接命中
+            cells = p.code_cells(result.define_function_code)
+            for key in {execution_key, p.execution_key(result.define_function_code)}:
+                execution_cache.set(key, out, err, p.file_name, cells)
+
+    if err is None:
+        logger.info('success to run code')
+        with open('./outputs/code.py', 'w') as f:
+            total_code = '\n'.join(cells)
+            f.write(total_code)
+    else:
+        logger.error('error to run code')
+        logger.error(err)
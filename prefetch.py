@@ -0,0 +1,90 @@
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pandas as pd
+from loguru import logger
+
+from cache import columnar_cache
+from introspect import read_preview
+from profiler import TableProfile, profile_table
+
+PREVIEW_ROWS = 10
+DEFAULT_WORKERS = 2
+
+
+def _prefetch_preview(path: str, digest: str, nrows: int) -> Dict[str | None, pd.DataFrame]:
+    columnar_cache.remember_hash(Path(path), digest)
+    return read_preview(Path(path), nrows)
+
+
+def _prefetch_profile(path: str, digest: str) -> TableProfile:
+    # 分析对齐后的 parquet 文件，结果写入磁盘缓存，页面进程直接复用
+    path = Path(path)
+    columnar_cache.remember_hash(path, digest)
+    return profile_table(path)
+
+
+# 上传文件后在后台进程中读取预览，数据对齐后分析字段，页面只需要等待尚未完成的部分
+class Prefetcher:
+
+    def __init__(self, workers: int = DEFAULT_WORKERS):
+        self.workers = workers
+        self._executor: ProcessPoolExecutor = None
+        self._futures: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+
+    def _submit(self, key: Tuple[str, str], fn, *args) -> Future:
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not (future.done() and future.exception() is not None):
+                return future
+            if self._executor is None:
+                # streamlit 服务进程是多线程的，使用 spawn 避免 fork 时复制其他线程持有的锁
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            logger.info(f'prefetch {key[1]}: {args[0]}')
+            self._futures[key] = future = self._executor.submit(fn, *args)
+            return future
+
+    def submit(self, path: Path, nrows: int = PREVIEW_ROWS):
+        digest = columnar_cache.content_hash(path)
+        self._submit((digest, f'preview:{nrows}'), _prefetch_preview, str(path), digest, nrows)
+
+    def submit_profile(self, path: Path):
+        digest = columnar_cache.content_hash(path)
+        self._submit((digest, 'profile'), _prefetch_profile, str(path), digest)
+
+    def get(self, path: Path, kind: str) -> Future | None:
+        return self._futures.get((columnar_cache.content_hash(path), kind))
+
+    def preview(self, path: Path, nrows: int = PREVIEW_ROWS) -> Dict[str | None, pd.DataFrame] | None:
+        # 有后台任务时等待其完成，没有提交过或者执行失败时返回 None，由页面自行读取
+        if (future := self.get(path, f'preview:{nrows}')) is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f'prefetch preview failed: {path.name}: {e}')
+            return None
+
+    def profile(self, path: Path, wait: bool = True) -> TableProfile | None:
+        if (future := self.get(path, 'profile')) is None or (not wait and not future.done()):
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.warning(f'prefetch profile failed: {path.name}: {e}')
+            return None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            self._futures.clear()
+
+
+prefetcher = Prefetcher()
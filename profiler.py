@@ -0,0 +1,241 @@
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from cache import columnar_cache
+
+DEFAULT_CACHE_DIR = Path().absolute() / '.cache' / 'profile'
+DEFAULT_SAMPLE_SIZE = 10_000
+DEFAULT_MAX_ROWS = 2_000_000
+DEFAULT_MAX_SECONDS = 5.0
+KMV_SIZE = 1024
+EXACT_COUNT_LIMIT = 10_000
+HEAVY_HITTERS = 256
+# 统计方法变化时递增，之前缓存的分析结果不再使用
+PROFILE_VERSION = 2
+BATCH_SIZE = 256 * 1024
+
+
+class ValueCount(BaseModel):
+    value: str = Field(description='取值')
+    count: int = Field(description='出现次数，抽样统计时为按比例换算的估计值')
+
+
+class ColumnProfile(BaseModel):
+    name: str = Field(description='字段名称')
+    dtype: str = Field(description='arrow 类型')
+    null_rate: float = Field(0.0, description='空值比例')
+    distinct: int = Field(0, description='不同值数量的估计')
+    distinct_exact: bool = Field(False, description='不同值数量是否为精确值')
+    top_values: List[ValueCount] = Field(default_factory=list, description='出现次数最多的取值')
+    examples: List[str] = Field(default_factory=list, description='示例取值')
+
+    def to_prompt_str(self) -> str:
+        distinct = f'{self.distinct}' if self.distinct_exact else f'约 {self.distinct}'
+        text = f'- {self.name}: {distinct} 个不同值, 空值 {self.null_rate:.1%}'
+        # 重复较多的字段展示常见取值，其余字段展示示例取值
+        if self.top_values and self.top_values[0].count > 1:
+            text += ', 常见值: ' + '、'.join(f'{x.value}({x.count})' for x in self.top_values)
+        elif self.examples:
+            text += ', 示例: ' + '、'.join(self.examples)
+        return text
+
+
+class TableProfile(BaseModel):
+    rows: int = Field(0, description='数据总行数')
+    scanned_rows: int = Field(0, description='实际扫描的行数')
+    seconds: float = Field(0.0, description='分析耗时')
+    columns: List[ColumnProfile] = Field(default_factory=list, description='每个字段的分析结果')
+
+    def to_prompt_str(self, columns: List[str] = None) -> str:
+        lines = [c.to_prompt_str() for c in self.columns if columns is None or c.name in columns]
+        if self.scanned_rows < self.rows:
+            lines.insert(0, f'（基于 {self.scanned_rows}/{self.rows} 行抽样统计）')
+        return '\n'.join(lines) + '\n'
+
+
+def _short(value, max_chars: int = 30) -> str:
+    text = str(value)
+    return text if len(text) <= max_chars else text[:max_chars] + '...'
+
+
+class _ColumnSketch:
+    # 单个字段的流式统计：空值计数、KMV 基数估计、不同值较少时的精确计数
+
+    def __init__(self, name: str, dtype: pa.DataType):
+        self.name = name
+        self.dtype = dtype
+        self.nulls = 0
+        self.kmv = np.empty(0, dtype=np.uint64)
+        self.counts: Counter | None = Counter()
+        # 不同值太多时改用 Misra-Gries 摘要统计常见取值，计数偏小，误差不超过 heavy_error
+        self.heavy: Dict | None = None
+        self.heavy_error = 0
+
+    def _merge_heavy(self, items: Dict):
+        for value, count in items.items():
+            self.heavy[value] = self.heavy.get(value, 0) + count
+        if len(self.heavy) > HEAVY_HITTERS:
+            cut = sorted(self.heavy.values(), reverse=True)[HEAVY_HITTERS]
+            self.heavy = {v: c - cut for v, c in self.heavy.items() if c > cut}
+            self.heavy_error += cut
+
+    def update(self, column: pa.Array):
+        self.nulls += column.null_count
+        vc = pc.value_counts(column.drop_null())
+        if self.counts is not None:
+            self.counts.update(dict(zip(vc.field('values').to_pylist(), vc.field('counts').to_pylist())))
+            if len(self.counts) > EXACT_COUNT_LIMIT:
+                # 不同值太多，改为使用摘要统计常见取值
+                counts, self.counts, self.heavy = self.counts, None, {}
+                self._merge_heavy(counts)
+        elif len(vc):
+            # 每个批次只合并出现次数最多的部分取值，被舍弃的取值的计数计入误差
+            keep = 2 * HEAVY_HITTERS
+            order = pc.array_sort_indices(vc.field('counts'), order='descending')
+            top = vc.take(order[:keep])
+            if len(vc) > keep:
+                self.heavy_error += vc.field('counts')[order[keep].as_py()].as_py()
+            self._merge_heavy(dict(zip(top.field('values').to_pylist(), top.field('counts').to_pylist())))
+
+        uniques = pc.unique(column.drop_null()).to_numpy(zero_copy_only=False)
+        if len(uniques):
+            # 取值已经去重，不需要 hash_array 再做一次分类编码
+            hashes = pd.util.hash_array(uniques, categorize=False)
+            if len(self.kmv) == KMV_SIZE:
+                hashes = hashes[hashes < self.kmv[-1]]
+            self.kmv = np.union1d(self.kmv, hashes)[:KMV_SIZE]
+
+    def top_values(self, top: int) -> List[tuple]:
+        if self.counts is not None:
+            return self.counts.most_common(top)
+        # 摘要中的计数最多偏小 heavy_error，只有计数明显超过误差的取值才能确定是常见值
+        items = sorted(self.heavy.items(), key=lambda x: -x[1])[:top]
+        return [(v, c) for v, c in items if c > max(self.heavy_error, 1)]
+
+    def distinct(self) -> tuple[int, bool]:
+        if self.counts is not None:
+            return len(self.counts), True
+        if len(self.kmv) < KMV_SIZE:
+            return len(self.kmv), True
+        # 第 k 小的哈希值越小，说明不同值越多
+        return int((KMV_SIZE - 1) / (float(self.kmv[-1]) / 2 ** 64)), False
+
+
+def _scale_distinct(distinct: int, seen: int, rows: int) -> int:
+    # 只扫描了部分行时，假设各取值出现次数相同，由 D * (1 - exp(-seen / D)) = distinct 反推全表的不同值数量
+    if seen >= rows or distinct == 0:
+        return distinct
+
+    def expected(d: int) -> float:
+        return d * -np.expm1(-seen / d)
+
+    # 扫描的行中的不同值数量本身可能是估计值，不能超过扫描的行数
+    distinct = min(distinct, seen)
+    lo, hi = distinct, rows
+    if expected(lo) >= distinct - 0.5:
+        return lo
+    if expected(hi) <= distinct:
+        return hi
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if expected(mid) < distinct:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+def _row_groups(meta: pq.FileMetaData, max_rows: int) -> List[int]:
+    # 超过 max_rows 时均匀选取部分行组，保证大表的分析时间有上限
+    groups = list(range(meta.num_row_groups))
+    if meta.num_rows <= max_rows or not groups:
+        return groups
+    n = max(1, int(len(groups) * max_rows / meta.num_rows))
+    return sorted({groups[int(i)] for i in np.linspace(0, len(groups) - 1, n)})
+
+
+def profile_parquet(path: Path,
+                    sample_size: int = DEFAULT_SAMPLE_SIZE,
+                    max_rows: int = DEFAULT_MAX_ROWS,
+                    max_seconds: float = DEFAULT_MAX_SECONDS,
+                    top: int = 5,
+                    n_examples: int = 3,
+                    seed: int = 0) -> TableProfile:
+    start = time.perf_counter()
+    f = pq.ParquetFile(path)
+    rng = np.random.default_rng(seed)
+    sketches = [_ColumnSketch(field.name, field.type) for field in f.schema_arrow]
+    # 蓄水池抽样，每个字段保存同一批被抽中的行
+    reservoir: Dict[str, list] = {s.name: [] for s in sketches}
+    seen = 0
+
+    for batch in f.iter_batches(batch_size=BATCH_SIZE, row_groups=_row_groups(f.metadata, max_rows)):
+        n = batch.num_rows
+        fill = min(max(sample_size - seen, 0), n)
+        # 蓄水池未满时直接放入，之后第 i 行以 k/i 的概率替换随机位置
+        positions = np.arange(seen + fill, seen + n)
+        slots = rng.integers(0, positions + 1) if len(positions) else np.empty(0, dtype=np.int64)
+        replace = slots < sample_size
+        rows, slots = positions[replace] - seen, slots[replace]
+
+        for s, column in zip(sketches, batch.columns):
+            s.update(column)
+            sample = reservoir[s.name]
+            sample += column.slice(0, fill).to_pylist()
+            for slot, value in zip(slots, column.take(pa.array(rows, type=pa.int64())).to_pylist()):
+                sample[slot] = value
+
+        seen += n
+        if time.perf_counter() - start > max_seconds:
+            logger.warning(f'profile {path.name} stopped after {seen} rows')
+            break
+
+    rows = f.metadata.num_rows
+    # 跳过了部分行组或者超时停止时，统计结果只覆盖扫描过的行，需要换算到全表且不再是精确值
+    scale = rows / seen if seen else 1.0
+    columns = []
+    for s in sketches:
+        sample = [x for x in reservoir[s.name] if x is not None]
+        distinct, exact = s.distinct()
+        if seen < rows:
+            distinct, exact = _scale_distinct(distinct, seen, rows), False
+        top_values = [ValueCount(value=_short(v), count=round(c * scale)) for v, c in s.top_values(top)]
+        columns.append(ColumnProfile(name=s.name,
+                                     dtype=str(s.dtype),
+                                     null_rate=s.nulls / seen if seen else 0.0,
+                                     distinct=distinct,
+                                     distinct_exact=exact,
+                                     top_values=top_values,
+                                     examples=[_short(v) for v in list(dict.fromkeys(sample))[:n_examples]]))
+
+    return TableProfile(rows=rows, scanned_rows=seen, seconds=time.perf_counter() - start,
+                        columns=columns)
+
+
+def profile_table(path: Path, cache_dir: Path = DEFAULT_CACHE_DIR, **kwargs) -> TableProfile:
+    # 以源文件内容哈希与参数为键缓存分析结果，后台任务与页面共享同一份结果
+    key = '_'.join([columnar_cache.content_hash(path), f'v{PROFILE_VERSION}'] +
+                   [f'{k}={v}' for k, v in sorted(kwargs.items())])
+    target = cache_dir / f'{key}.json'
+    if target.exists():
+        return TableProfile.model_validate_json(target.read_text(encoding='utf-8'))
+
+    # 数据对齐后的文件本身就是 parquet，不需要再转换
+    profile = profile_parquet(path if path.suffix == '.parquet' else columnar_cache.get(path), **kwargs)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # 多个后台任务可能同时分析同一个文件，临时文件名不能冲突
+    tmp = target.with_name(f'{target.stem}.{uuid.uuid4().hex}.tmp')
+    tmp.write_text(profile.model_dump_json(), encoding='utf-8')
+    tmp.replace(target)
+    return profile
@@ -1,89 +1,513 @@
+import gc
+import os
+import queue
 import re
+import resource
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import uuid
+from abc import ABC, abstractmethod
+from collections import Counter
+from contextlib import contextmanager
 from functools import partial
 from pathlib import Path
-from subprocess import CompletedProcess
-from typing import List, Tuple, Literal
+from typing import Dict, Iterator, List, Tuple, Literal
 
 from IPython.terminal.interactiveshell import TerminalInteractiveShell
 from IPython.utils.capture import capture_output
 from loguru import logger
+from pydantic import BaseModel, Field
+
+WARMUP_CODE = 'import pandas as pd\nimport numpy as np'
+DEFAULT_SANDBOX_ROOT = Path().absolute() / '.cache' / 'sandbox'
+PROFILE_CELL_PATTERN = re.compile(r'^\s*\w+\s*=\s*process_data\(', re.MULTILINE)
+
+
+def current_rss() -> int:
+    import psutil
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+class Hotspot(BaseModel):
+    function: str = Field(description='函数名称')
+    filename: str = Field(description='文件名称')
+    lineno: int = Field(description='行号')
+    samples: int = Field(description='采样次数')
+    fraction: float = Field(description='采样占比')
+    leaf: str | None = Field(None, description='该行中采样最多的最内层调用，与该行相同时为空')
+
+
+class CellRecord(BaseModel):
+    index: int = Field(description='代码块序号')
+    wall_seconds: float = Field(description='运行时间')
+    cpu_seconds: float = Field(description='执行线程的 CPU 时间')
+    memory_delta_bytes: int = Field(description='执行前后常驻内存的变化')
+    success: bool = Field(description='ExecutionResult 是否执行成功')
+    error: str | None = Field(None, description='执行错误')
+    hotspots: List[Hotspot] = Field(default_factory=list, description='采样分析得到的热点')
+
+
+class SamplingProfiler:
+    # 在后台线程中定时采样目标线程的调用栈，按用户代码（ipython 代码块）中最内层的代码行统计热点，
+    # 同时记录该行中采样最多的最内层调用，不依赖额外的第三方库
+    CELL_FILE_PREFIX = '<ipython-input-'
+
+    def __init__(self, interval: float = 0.005, top: int = 10):
+        self.interval = interval
+        self.top = top
+        self.samples = Counter()
+        self.leaves: Dict[Tuple[str, str, int], Counter] = {}
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def _key(frame) -> Tuple[str, str, int]:
+        return frame.f_code.co_name, frame.f_code.co_filename, frame.f_lineno
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            leaf = sys._current_frames().get(self._target)
+            if leaf is None:
+                continue
+            frame = leaf
+            while frame is not None and not frame.f_code.co_filename.startswith(self.CELL_FILE_PREFIX):
+                frame = frame.f_back
+            # 调用栈中没有用户代码时按最内层代码行统计
+            key = self._key(frame if frame is not None else leaf)
+            self.samples[key] += 1
+            self.leaves.setdefault(key, Counter())[self._key(leaf)] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def hotspots(self) -> List[Hotspot]:
+        total = sum(self.samples.values())
+        result = []
+        for key, n in self.samples.most_common(self.top):
+            function, filename, lineno = key
+            (leaf_function, leaf_filename, leaf_lineno), _ = self.leaves[key].most_common(1)[0]
+            leaf = None if (leaf_function, leaf_filename, leaf_lineno) == key else \
+                f'{leaf_function} ({leaf_filename}:{leaf_lineno})'
+            result.append(Hotspot(function=function, filename=filename, lineno=lineno, samples=n, fraction=n / total,
+                                  leaf=leaf))
+        return result
 
 
 class InteractivePythonRunner:
     ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
     ERROR_DELIMITERS = '-' * 75
 
-    def __init__(self, ipython_dir: Path, raise_error: bool = True):
+    def __init__(self, ipython_dir: Path, raise_error: bool = True, warmup_code: str = None):
         self.ipython_dir = str(ipython_dir)
         self.shell: TerminalInteractiveShell = None
         self.raise_error = raise_error
+        self.warmup_code = warmup_code
+        self.jobs = 0
+        self.records: List[CellRecord] = []
 
-    def run(self, code: str | List[str]) -> Tuple[str, str | None]:
+    def run_cell(self, index: int, code: str, profile: bool = False) -> CellRecord:
+        rss, wall, cpu = current_rss(), time.perf_counter(), time.thread_time()
+        if profile:
+            with SamplingProfiler() as profiler:
+                result = self.shell.run_cell(code)
+            hotspots = profiler.hotspots()
+        else:
+            result = self.shell.run_cell(code)
+            hotspots = []
 
+        error = result.error_before_exec or result.error_in_exec
+        return CellRecord(index=index,
+                          wall_seconds=time.perf_counter() - wall,
+                          cpu_seconds=time.thread_time() - cpu,
+                          memory_delta_bytes=current_rss() - rss,
+                          success=result.success,
+                          error=None if error is None else repr(error),
+                          hotspots=hotspots)
+
+    def run(self, code: str | List[str], profile: bool = False) -> Tuple[str, str | None]:
+        # 每个代码块的耗时与内存记录保存在 self.records 中，profile 为 True 时对调用 process_data 的代码块采样分析
+        self.records = []
         with capture_output() as capture:
             code = code if isinstance(code, list) else [code]
-            for c in code:
+            for i, c in enumerate(code):
                 logger.info(f'run code: {c}')
-                self.shell.run_cell(c)
+                self.records.append(self.run_cell(i, c, profile=profile and PROFILE_CELL_PATTERN.search(c) is not None))
 
         text = self.ANSI_ESCAPE.sub('', capture.stdout)
         if self.ERROR_DELIMITERS in text:
-            out, err = text.split(self.ERROR_DELIMITERS)
+            out, err = text.split(self.ERROR_DELIMITERS, 1)
         else:
             out, err = text, None
         return out, err
 
-    def __enter__(self):
+    def open(self):
         logger.info('create ipython instance')
         self.shell = TerminalInteractiveShell(ipython_dir=self.ipython_dir)
+        if self.warmup_code:
+            self.shell.run_cell(self.warmup_code)
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def reset(self):
+        # 清空用户命名空间，已导入的模块仍保留在 sys.modules 中，重新导入几乎没有开销
+        self.shell.reset(new_session=False)
+        if self.warmup_code:
+            self.shell.run_cell(self.warmup_code)
+
+    def close(self):
+        # exit() 不会释放实例，需要清空命名空间、结束历史记录会话并停止其保存线程，否则重建内核时内存与线程持续增长
         logger.info('close ipython instance')
-        self.shell.run_cell('exit()')
+        shell, self.shell = self.shell, None
+        shell.reset(new_session=False)
+        shell.history_manager.end_session()
+        if (save_thread := getattr(shell.history_manager, 'save_thread', None)) is not None:
+            save_thread.stop()
+        shell.run_cell('exit()')
+        TerminalInteractiveShell.clear_instance()
+        gc.collect()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
         if exc_type is not None and self.raise_error == 'raise':
             raise exc_val
 
 
+class PoolMetrics(BaseModel):
+    checkouts: int = Field(0, description='租用次数')
+    recycled: int = Field(0, description='回收重建的实例数量')
+    wait_seconds_total: float = Field(0.0, description='等待租用的总耗时')
+    wait_seconds_max: float = Field(0.0, description='等待租用的最大耗时')
+    exec_seconds_total: float = Field(0.0, description='租用期间执行的总耗时')
+    exec_seconds_max: float = Field(0.0, description='租用期间执行的最大耗时')
+
+    @property
+    def wait_seconds_avg(self) -> float:
+        return self.wait_seconds_total / self.checkouts if self.checkouts else 0.0
+
+    @property
+    def exec_seconds_avg(self) -> float:
+        return self.exec_seconds_total / self.checkouts if self.checkouts else 0.0
+
+
+class LeasePool(ABC):
+    # 预先创建一批实例，按任务租用，归还时重置，使用次数过多时销毁重建
+    name = 'instance'
+
+    def __init__(self, size: int = 2, max_jobs: int = 50):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.metrics = PoolMetrics()
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _create(self):
+        ...
+
+    @abstractmethod
+    def _reset(self, item):
+        ...
+
+    @abstractmethod
+    def _destroy(self, item):
+        ...
+
+    def _should_recycle(self, item) -> bool:
+        return item.jobs >= self.max_jobs
+
+    def start(self):
+        for _ in range(self.size):
+            self._idle.put(self._create())
+        return self
+
+    def shutdown(self):
+        while not self._idle.empty():
+            self._destroy(self._idle.get_nowait())
+
+    def _release(self, item):
+        if self._should_recycle(item):
+            logger.info(f'recycle {self.name} after {item.jobs} jobs')
+            self._destroy(item)
+            with self._lock:
+                self.metrics.recycled += 1
+            item = self._create()
+        else:
+            self._reset(item)
+        self._idle.put(item)
+
+    @contextmanager
+    def lease(self, timeout: float = None) -> Iterator:
+        start = time.perf_counter()
+        item = self._idle.get(timeout=timeout)
+        wait = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            yield item
+        finally:
+            elapsed = time.perf_counter() - start
+            item.jobs += 1
+            with self._lock:
+                m = self.metrics
+                m.checkouts += 1
+                m.wait_seconds_total += wait
+                m.wait_seconds_max = max(m.wait_seconds_max, wait)
+                m.exec_seconds_total += elapsed
+                m.exec_seconds_max = max(m.exec_seconds_max, elapsed)
+            self._release(item)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+class KernelPool(LeasePool):
+    # 预先创建并导入 pandas/numpy 的 ipython 内核，归还时重置命名空间，内核创建后进程内存增长超过阈值时重建
+    # 注意：内核运行在当前进程内，捕获输出依赖全局 sys.stdout，同一进程内的租用应串行执行
+    name = 'ipython instance'
+
+    def __init__(self,
+                 ipython_dir: Path,
+                 size: int = 2,
+                 max_jobs: int = 50,
+                 max_rss_bytes: int = 4 * 1024 ** 3,
+                 warmup_code: str = WARMUP_CODE):
+        super().__init__(size=size, max_jobs=max_jobs)
+        self.ipython_dir = ipython_dir
+        self.max_rss_bytes = max_rss_bytes
+        self.warmup_code = warmup_code
+
+    def _create(self) -> InteractivePythonRunner:
+        kernel = InteractivePythonRunner(self.ipython_dir, warmup_code=self.warmup_code).open()
+        # 内核与宿主共用一个进程，只能以创建时的进程内存为基线估算内核占用
+        kernel.base_rss = current_rss()
+        return kernel
+
+    def _reset(self, kernel: InteractivePythonRunner):
+        kernel.reset()
+
+    def _destroy(self, kernel: InteractivePythonRunner):
+        kernel.close()
+
+    def _should_recycle(self, kernel: InteractivePythonRunner) -> bool:
+        return super()._should_recycle(kernel) or current_rss() - kernel.base_rss > self.max_rss_bytes
+
+
+class ExecutionPolicy(BaseModel):
+    timeout_seconds: float | None = Field(None, description='最长运行时间（秒）')
+    max_rss_bytes: int | None = Field(None, description='最大常驻内存')
+    max_cpu_seconds: int | None = Field(None, description='最长 CPU 时间（秒）')
+    max_output_bytes: int | None = Field(10 * 1024 ** 2, description='标准输出与错误输出的总大小上限')
+    poll_interval: float = Field(0.05, description='检查资源使用情况的间隔（秒）')
+
+
+class ScriptResult(BaseModel):
+    returncode: int = Field(description='进程退出码，被信号终止时为负数')
+    stdout: str = Field('', description='标准输出')
+    stderr: str = Field('', description='错误输出')
+    wall_seconds: float = Field(0.0, description='运行时间')
+    cpu_seconds: float = Field(0.0, description='CPU 时间（用户态 + 内核态）')
+    peak_rss_bytes: int = Field(0, description='峰值常驻内存')
+    exit_reason: Literal['ok', 'error', 'timeout', 'memory', 'cpu', 'output', 'cancelled'] = Field(description='退出原因')
+
+
 class PythonRunner:
 
-    def __init__(self, interpreter_path: Path):
+    def __init__(self,
+                 interpreter_path: Path,
+                 policy: ExecutionPolicy = None,
+                 cwd: Path = None,
+                 env: Dict[str, str] = None):
         self.interpreter_path = interpreter_path
+        self.policy = policy or ExecutionPolicy()
+        # 脚本中相对路径的写入落在 cwd 中，不指定时为当前进程的工作目录
+        self.cwd = cwd
+        self.env = env
+
+    def _limit_resources(self, pid: int = None):
+        # CPU 时间由内核限制，超过软限制时收到 SIGXCPU；
+        # preexec_fn 在有其他线程运行时 fork 并不安全，linux 下启动后通过 prlimit 设置子进程的限制
+        cpu = self.policy.max_cpu_seconds
+        if pid is None:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        else:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu, cpu + 1))
+
+    def _check(self, started: float, rss: int, output_bytes: int) -> str | None:
+        policy = self.policy
+        if policy.timeout_seconds is not None and time.perf_counter() - started > policy.timeout_seconds:
+            return 'timeout'
+        if policy.max_rss_bytes is not None and rss > policy.max_rss_bytes:
+            return 'memory'
+        if policy.max_output_bytes is not None and output_bytes > policy.max_output_bytes:
+            return 'output'
+        return None
 
-    def run_script(self, script: Path) -> CompletedProcess:
-        args = [str(self.interpreter_path), str(script)]
-        return subprocess.run(args, capture_output=True, text=True)
+    def run_script(self, script: Path, stop: threading.Event = None) -> ScriptResult:
+        # stop 被设置时结束进程，用于在其他线程中取消执行
+        import psutil
+
+        args = [str(self.interpreter_path), str(script.absolute())]
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            started = time.perf_counter()
+            limit_cpu = self.policy.max_cpu_seconds is not None
+            preexec = limit_cpu and not hasattr(resource, 'prlimit')
+            proc = subprocess.Popen(args, stdout=out, stderr=err, cwd=self.cwd, env=self.env,
+                                    preexec_fn=self._limit_resources if preexec else None)
+            if limit_cpu and not preexec:
+                self._limit_resources(proc.pid)
+            ps = psutil.Process(proc.pid)
+            reason, peak_rss = None, 0
+
+            while True:
+                pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                if pid != 0:
+                    break
+                try:
+                    rss = ps.memory_info().rss
+                except psutil.NoSuchProcess:
+                    rss = 0
+                peak_rss = max(peak_rss, rss)
+                output_bytes = os.fstat(out.fileno()).st_size + os.fstat(err.fileno()).st_size
+                if stop is not None and stop.is_set():
+                    reason = 'cancelled'
+                else:
+                    reason = self._check(started, rss, output_bytes)
+                if reason is not None:
+                    logger.warning(f'kill script {script}: {reason}')
+                    proc.kill()
+                    pid, status, usage = os.wait4(proc.pid, 0)
+                    break
+                time.sleep(self.policy.poll_interval)
+
+            wall_seconds = time.perf_counter() - started
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            cpu_seconds = usage.ru_utime + usage.ru_stime
+            # linux 下 ru_maxrss 的单位是 KB，macOS 下是字节
+            peak_rss = max(peak_rss, usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024))
+
+            if reason is None:
+                cpu_limit = self.policy.max_cpu_seconds
+                if proc.returncode == -signal.SIGXCPU or (
+                        proc.returncode == -signal.SIGKILL and cpu_limit and cpu_seconds >= cpu_limit):
+                    reason = 'cpu'
+                else:
+                    reason = 'ok' if proc.returncode == 0 else 'error'
+
+            limit = self.policy.max_output_bytes
+            out.seek(0)
+            err.seek(0)
+            return ScriptResult(returncode=proc.returncode,
+                                stdout=out.read(limit).decode(errors='replace'),
+                                stderr=err.read(limit).decode(errors='replace'),
+                                wall_seconds=wall_seconds,
+                                cpu_seconds=cpu_seconds,
+                                peak_rss_bytes=peak_rss,
+                                exit_reason=reason)
+
+
+class SandboxEnv:
+    # 基于基础环境创建的 venv 覆盖层：通过 --system-site-packages 共享基础环境的依赖，
+    # 运行时新安装的包和产生的文件只写入覆盖层，重置时直接清空即可
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.python_path = root / 'bin' / 'python'
+        self.work_dir = root / 'work'
+        self.jobs = 0
+
+    @property
+    def site_packages(self) -> List[Path]:
+        return list(self.root.glob('lib/python*/site-packages'))
+
+    def reset(self):
+        for d in self.site_packages + [self.work_dir]:
+            if d.exists():
+                shutil.rmtree(d)
+            d.mkdir(parents=True)
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class SandboxEnvPool(LeasePool):
+    name = 'sandbox env'
+
+    def __init__(self,
+                 base_python: Path,
+                 root: Path = DEFAULT_SANDBOX_ROOT,
+                 size: int = 2,
+                 max_jobs: int = 100):
+        super().__init__(size=size, max_jobs=max_jobs)
+        self.base_python = base_python
+        self.root = root
+
+    def _create(self) -> SandboxEnv:
+        env = SandboxEnv(self.root / uuid.uuid4().hex)
+        logger.info(f'create sandbox env: {env.root}')
+        args = [str(self.base_python), '-m', 'venv', '--system-site-packages', '--without-pip', str(env.root)]
+        subprocess.run(args, capture_output=True, text=True, check=True)
+        env.reset()
+        return env
+
+    def _reset(self, env: SandboxEnv):
+        env.reset()
+
+    def _destroy(self, env: SandboxEnv):
+        env.remove()
 
 
 class CondaEnv:
     BASE_CONDA_ENV_PATH = '/Users/lzx/miniconda3/envs/runner'
     BASE_CONDA_ENV_NAME = 'runner'
+    _default_pool: SandboxEnvPool = None
 
-    def __init__(self, env_name: str = None):
+    def __init__(self, env_name: str = None, pool: SandboxEnvPool = None, policy: ExecutionPolicy = None):
         self.env_name = env_name or uuid.uuid4().hex
+        self.pool = pool
+        self.policy = policy
+        self.env: SandboxEnv = None
         self.py_console: InteractivePythonRunner = None
         self.py_runner: PythonRunner = None
+        self._lease = None
+
+    @classmethod
+    def default_pool(cls) -> SandboxEnvPool:
+        if cls._default_pool is None:
+            base_python = Path(cls.BASE_CONDA_ENV_PATH) / 'bin' / 'python'
+            cls._default_pool = SandboxEnvPool(base_python=base_python).start()
+        return cls._default_pool
 
-    def run_script(self, script: Path) -> CompletedProcess:
+    def run_script(self, script: Path) -> ScriptResult:
         return self.py_runner.run_script(script)
 
     def __enter__(self):
-        logger.info(f'create new conda env: {self.env_name}')
-        args = ['conda', 'create', '--name', self.env_name, '--clone', self.BASE_CONDA_ENV_NAME]
-        result = subprocess.run(args, capture_output=True, text=True)
-        logger.info(result.stdout)
-
-        args = ['conda', 'run', '--name', self.env_name, 'which', 'python']
-        python_path = subprocess.run(args, capture_output=True, text=True).stdout.strip()
-        logger.info(f'python_path: {python_path}')
-        self.py_runner = PythonRunner(interpreter_path=Path(python_path))
-        self.py_console = partial(InteractivePythonRunner, interpreter=Path(python_path).parent)
+        # 从预先创建好的沙箱环境池中租用，不再每次执行 conda create --clone
+        pool = self.pool or self.default_pool()
+        self._lease = pool.lease()
+        self.env = self._lease.__enter__()
+        logger.info(f'lease sandbox env for {self.env_name}: {self.env.root}')
+
+        python_path = self.env.python_path
+        self.py_runner = PythonRunner(interpreter_path=python_path, policy=self.policy, cwd=self.env.work_dir)
+        self.py_console = partial(InteractivePythonRunner, ipython_dir=python_path.parent)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        logger.info(f'remove conda env: {self.env_name}')
-        args = ['conda', 'env', 'remove', '--name', self.env_name]
-        subprocess.run(args, capture_output=True, text=True)
-        return self
+        logger.info(f'return sandbox env for {self.env_name}: {self.env.root}')
+        self._lease.__exit__(exc_type, exc_val, exc_tb)
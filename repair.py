@@ -0,0 +1,77 @@
+import time
+from typing import Dict, List
+
+from loguru import logger
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel, Field
+
+from pyrunner import CellRecord, InteractivePythonRunner
+from schema import QueryPrompt
+from utils import call_openai_llm, extract_code
+
+DEFAULT_MAX_RETRIES = 3
+
+
+class RepairAttempt(BaseModel):
+    attempt: int = Field(description='第几次执行，0 表示首次执行')
+    code: str = Field(description='本次执行的 process_data 代码')
+    error: str | None = Field(None, description='错误信息')
+    llm_seconds: float = Field(0.0, description='修复请求耗时')
+    exec_seconds: float = Field(0.0, description='代码执行耗时')
+    cells: List[CellRecord] = Field(default_factory=list, description='每个代码块的执行记录')
+
+
+class RepairResult(BaseModel):
+    out: str = Field('', description='标准输出')
+    err: str | None = Field(None, description='最后一次执行的错误信息')
+    define_function_code: str = Field(description='最后一次执行的 process_data 代码')
+    attempts: List[RepairAttempt] = Field(default_factory=list, description='每次执行的记录')
+
+
+def run_with_repair(runner: InteractivePythonRunner,
+                    p: QueryPrompt,
+                    messages: List[Dict],
+                    completion: ChatCompletion,
+                    max_retries: int = DEFAULT_MAX_RETRIES,
+                    model: str = 'gpt-3.5-turbo',
+                    profile: bool = False) -> RepairResult:
+    # 执行出错时把错误信息反馈给模型，在同一个内核中只重新定义并执行 process_data，已读取的 df_i 不会重新加载
+    messages = list(messages)
+    code = extract_code(completion)
+    cells = p.code_cells(code)
+    offset = 0
+    result = RepairResult(define_function_code=code)
+
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        out, err = runner.run(cells, profile=profile)
+        record = RepairAttempt(attempt=attempt, code=code, error=err, exec_seconds=time.perf_counter() - start,
+                               cells=runner.records)
+        result.attempts.append(record)
+        result.out, result.err, result.define_function_code = out, err, code
+        if err is None:
+            break
+
+        failed = next((r.index + offset for r in runner.records if not r.success), None)
+        if failed is not None and failed < p.REPAIR_FROM:
+            # 导入或读取数据失败，与 process_data 无关，修复代码没有意义
+            logger.error('error to load input data, skip repair')
+            break
+        if attempt == max_retries:
+            break
+
+        logger.warning(f'error to run code, repair attempt {attempt + 1}/{max_retries}')
+        messages += [{'role': 'assistant', 'content': completion.choices[0].message.content},
+                     {'role': 'user', 'content': p.repair_prompt(err)}]
+        start = time.perf_counter()
+        try:
+            completion = call_openai_llm(messages, model=model)
+            code = extract_code(completion)
+        except Exception as e:
+            logger.error(f'error to request repair: {e}')
+            break
+        finally:
+            record.llm_seconds = time.perf_counter() - start
+        cells, offset = p.repair_cells(code), p.REPAIR_FROM
+
+    return result
@@ -1,58 +1,236 @@
-import io
+from collections import Counter
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import ClassVar, Dict, List, Literal
 
 import pandas as pd
-from pydantic import BaseModel, Field
+import pyarrow as pa
+from pydantic import BaseModel, Field, model_validator
 
-from tmpl import MAIN_TMPL
+from cache import columnar_cache, execution_cache
+from exporter import OUTPUT_SUFFIX, OutputFormat, export_code, export_imports
+from introspect import TableSchema, count_distinct, scan_table
+from profiler import TableProfile, profile_table
+from summarize import name_score, summarize_tables
+from tmpl import DUCKDB_MAIN_TMPL, MAIN_TMPL, REPAIR_TMPL
+
+# 文档页面 ColumnField.type 中常见的类型名称对应的 arrow 类型
+DTYPE_MAPPING = {
+    'string': 'string[pyarrow]', 'str': 'string[pyarrow]', 'text': 'string[pyarrow]',
+    '字符串': 'string[pyarrow]', '文本': 'string[pyarrow]',
+    'int': 'int64[pyarrow]', 'integer': 'int64[pyarrow]', '整数': 'int64[pyarrow]',
+    'float': 'double[pyarrow]', 'double': 'double[pyarrow]', 'number': 'double[pyarrow]',
+    '数值': 'double[pyarrow]', '浮点数': 'double[pyarrow]',
+    'bool': 'bool[pyarrow]', 'boolean': 'bool[pyarrow]', '布尔': 'bool[pyarrow]',
+}
+# dtype_backend='pyarrow' 读取后，扫描得到的 pandas 类型实际对应的类型，用于提示词中的表信息
+ARROW_DTYPES = {'object': 'string[pyarrow]', 'str': 'string[pyarrow]', 'int64': 'int64[pyarrow]', 'float64': 'double[pyarrow]',
+                'bool': 'bool[pyarrow]', 'datetime64[ns]': 'timestamp[ns][pyarrow]',
+                'datetime64[us]': 'timestamp[us][pyarrow]'}
+
+
+@lru_cache(maxsize=256)
+def _scan_table(path: Path, digest: str) -> TableSchema:
+    # 以文件内容哈希为键缓存扫描结果，重复构建提示词时不需要重新扫描文件
+    return scan_table(path)
 
 
 class DataFrameInfo(BaseModel):
     name: str = Field(description='表格名称')
     path: Path = Field(description='存储路径')
+    column_types: Dict[str, str] = Field(default_factory=dict, description='字段声明的类型，例如文档页面中的 ColumnField.type')
 
     @property
-    def df(self):
-        suffix = self.path.suffix
-        if suffix == '.xlsx':
-            return pd.read_excel(self.path)
-        if suffix == '.csv':
-            return pd.read_csv(self.path)
-        raise Exception('not found')
+    def df(self) -> pd.DataFrame:
+        return columnar_cache.load(self.path)
+
+    @property
+    def cache_path(self) -> Path:
+        return columnar_cache.get(self.path)
+
+    @property
+    def arrow_path(self) -> Path:
+        return columnar_cache.get(self.path, 'arrow')
+
+    @property
+    def arrow_dtypes(self) -> Dict[str, str]:
+        # 以 ArrowDtype 读取 arrow 缓存后各字段的实际类型，只读取文件中的 schema
+        with pa.memory_map(str(self.arrow_path)) as source:
+            schema = pa.ipc.open_file(source).schema
+        return {field.name: str(pd.ArrowDtype(field.type)) for field in schema}
+
+    @property
+    def table_schema(self) -> TableSchema:
+        return _scan_table(self.path, columnar_cache.content_hash(self.path))
+
+    @property
+    def profile(self) -> TableProfile:
+        return profile_table(self.path)
 
 
 class QueryPrompt(BaseModel):
     dfs: List[DataFrameInfo] = Field(description='表名称以及描述')
     query: str = Field(description='用户提问')
     file_name: Path = Field(Path().absolute() / 'outputs/output.csv', description='输出文件路径名称')
+    data_format: Literal['source', 'parquet', 'arrow'] = Field(
+        'parquet', description='生成的读取代码加载数据的方式：原始文件、parquet 缓存或内存映射的 arrow 缓存')
+    engine: Literal['pandas', 'duckdb'] = Field('pandas', description='生成代码使用的计算引擎')
+    output_format: OutputFormat = Field('csv', description='输出结果的文件格式：csv、parquet 或 arrow ipc')
+    export_chunk_rows: int = Field(256 * 1024, description='分块写出时每块的行数')
+    plan: str = Field('', description='处理步骤描述，与提问一起用于判断需要读取的字段')
+    typed_readers: bool = Field(False, description='生成指定类型、分类类型以及 arrow 字符串的读取代码')
+    prune_columns: bool = Field(False, description='只读取提问与处理步骤中引用到的字段')
+    category_max_ratio: float = Field(0.05, description='不同值数量占行数比例不超过该值的字符串字段读取为分类类型')
+    schema_token_budget: int | None = Field(None, description='表信息的 token 预算，设置后按与提问的相关程度压缩表信息')
+    include_profile: bool = Field(False, description='在表信息中加入字段的不同值数量、空值比例与常见取值')
+
+    # code_cells 中 process_data 定义所在的位置，之前是导入与读取数据
+    REPAIR_FROM: ClassVar[int] = 2
+
+    @model_validator(mode='after')
+    def match_output_suffix(self):
+        # 输出文件的后缀与输出格式保持一致
+        self.file_name = self.file_name.with_suffix(OUTPUT_SUFFIX[self.output_format])
+        return self
 
     def generate_prompt(self):
-        return MAIN_TMPL.format(dataframe_desc=self.get_df_info_str(),
-                                query=self.query,
-                                import_package=self.import_package(),
-                                read_pd_data=self.read_pd_data(),
-                                export_result=self.export_result(),
-                                exec_function=self.exec_function())
+        tmpl = DUCKDB_MAIN_TMPL if self.engine == 'duckdb' else MAIN_TMPL
+        return tmpl.format(dataframe_desc=self.get_df_info_str(),
+                           query=self.query,
+                           import_package=self.import_package(),
+                           read_pd_data=self.read_pd_data(),
+                           export_result=self.export_result(),
+                           exec_function=self.exec_function())
 
     def get_df_info_str(self):
-        result = []
+        tables = []
         for n, x in enumerate(self.dfs):
-            buffer = io.StringIO()
-            x.df.info(buf=buffer)
-            string = f'df_{n}: ' + x.name + '\n' + '```\n' + buffer.getvalue() + '```\n'
-            result.append(string)
+            schema = x.table_schema
+            arrow = self.data_format == 'arrow'
+            if self.engine == 'pandas' and (arrow or self.typed_readers or self.prune_columns):
+                # 表信息与生成的读取代码保持一致，只展示读取的字段及其实际类型
+                columns = self.used_columns(x)
+                if arrow:
+                    # arrow 文件总是以 ArrowDtype 读取，直接使用文件中的类型
+                    dtypes = x.arrow_dtypes
+                elif self.typed_readers:
+                    dtypes = {c.name: ARROW_DTYPES.get(c.dtype, c.dtype) for c in schema.columns}
+                else:
+                    dtypes = {}
+                schema = schema.select(columns, {**dtypes, **self.reader_dtypes(x, columns)})
+            elif self.engine == 'duckdb':
+                # DuckDB 模式下输入是关系对象，展示关系中的字段名称与 DuckDB 类型（csv 的空列名等与 pandas 不同，按位置对应）
+                schema = TableSchema(rows=schema.rows,
+                                     columns=[c.model_copy(update={'name': name, 'dtype': dtype})
+                                              for c, (name, dtype) in zip(schema.columns, self.duckdb_types(x).items())])
+            tables.append((f'df_{n}: ' + x.name, schema))
+
+        text = self.query + self.plan
+        if self.schema_token_budget is not None:
+            result = [summarize_tables(tables, text, self.schema_token_budget)]
+        else:
+            result = [name + '\n' + '```\n' + (schema.to_relation_str() if self.engine == 'duckdb' else schema.to_info_str())
+                      + '```\n' for name, schema in tables]
+
+        if self.include_profile:
+            for x, (name, schema) in zip(self.dfs, tables):
+                columns = [c.name for c in schema.columns]
+                if self.schema_token_budget is not None:
+                    # 压缩表信息时只补充提问中提到的字段，避免超出预算太多
+                    columns = [c for c in columns if name_score(c, text) == 1.0]
+                if columns:
+                    result.append(f'{name} 字段取值\n```\n{x.profile.to_prompt_str(columns)}```\n')
         return '\n'.join(result)
 
     def read_pd_data(self):
         result = []
         for n, x in enumerate(self.dfs):
             string = f'# {x.name}\n'
-            string += f'df_{n}: pd.DataFrame = {self.pd_read_method(x.path)}("{str(x.path.absolute())}")\n'
-            self.pd_read_method(x.path)
+            if self.engine == 'duckdb':
+                string += f'df_{n}: duckdb.DuckDBPyRelation = {self.duckdb_read_expr(x)}\n'
+            else:
+                string += f'df_{n}: pd.DataFrame = {self.read_expr(x)}\n'
             result.append(string)
         return '\n'.join(result)
 
+    def used_columns(self, x: DataFrameInfo) -> List[str] | None:
+        # 提问与处理步骤中出现过的字段，没有匹配到任何字段时读取全部字段
+        if not self.prune_columns:
+            return None
+        text = self.query + self.plan
+        names = [c.name for c in x.table_schema.columns]
+        if not any(name in text for name in names):
+            return None
+        # 多个表共有的字段很可能是关联键，提问中没有写出字段名称时也保留
+        shared = {name for name, n in Counter(c.name for y in self.dfs for c in y.table_schema.columns).items() if n > 1}
+        return [name for name in names if name in text or name in shared]
+
+    def reader_dtypes(self, x: DataFrameInfo, columns: List[str] | None) -> Dict[str, str]:
+        if not self.typed_readers:
+            return {}
+        schema = x.table_schema
+        dtypes, strings = {}, []
+        for c in schema.columns:
+            if columns is not None and c.name not in columns:
+                continue
+            declared = DTYPE_MAPPING.get(str(x.column_types.get(c.name, '')).strip().lower())
+            if declared is not None:
+                dtypes[c.name] = declared
+            if declared == 'string[pyarrow]' or (declared is None and c.dtype in ('object', 'str')):
+                strings.append(c.name)
+
+        # 类别、渠道编号这类重复值很多的编码字段使用分类类型
+        if strings and schema.rows > 0:
+            for name, n in count_distinct(x.cache_path, tuple(strings)).items():
+                if n <= schema.rows * self.category_max_ratio:
+                    dtypes[name] = 'category'
+        return dtypes
+
+    def read_expr(self, x: DataFrameInfo):
+        columns = self.used_columns(x)
+        dtypes = self.reader_dtypes(x, columns)
+        astype = f'.astype({dtypes!r})' if dtypes else ''
+
+        if self.data_format == 'arrow':
+            # 内存映射 arrow 文件并使用 ArrowDtype，数据不会被复制到内核进程的堆内存中
+            select = f'.select({columns!r})' if columns else ''
+            return (f'pa.ipc.open_file(pa.memory_map("{str(x.arrow_path.absolute())}"))'
+                    f'.read_all(){select}.to_pandas(types_mapper=pd.ArrowDtype){astype}')
+
+        backend = ["dtype_backend='pyarrow'"] if self.typed_readers else []
+        if self.data_format == 'parquet' or x.path.suffix == '.parquet':
+            args = [f'"{str(x.cache_path.absolute())}"'] + ([f'columns={columns!r}'] if columns else []) + backend
+            return f'pd.read_parquet({", ".join(args)}){astype}'
+
+        # 原始文件在读取时指定类型，编码类字段不会先被解析成数字丢失前导零
+        args = [f'"{str(x.path.absolute())}"'] + ([f'usecols={columns!r}'] if columns else [])
+        args += ([f'dtype={dtypes!r}'] if dtypes else []) + backend
+        return f'{self.pd_read_method(x.path)}({", ".join(args)})'
+
+    def duckdb_read_expr(self, x: DataFrameInfo):
+        # DuckDB 直接扫描文件，数据按需读取并在引擎内部多线程执行，不需要全部加载到内存
+        if self.data_format == 'arrow':
+            return f'con.from_arrow(pa.ipc.open_file(pa.memory_map("{str(x.arrow_path.absolute())}")).read_all())'
+        if self.data_format == 'source' and x.path.suffix == '.csv':
+            return f'con.read_csv("{str(x.path.absolute())}")'
+        # xlsx 无法被 DuckDB 直接高效扫描，统一使用 parquet 缓存
+        return f'con.read_parquet("{str(x.cache_path.absolute())}")'
+
+    def duckdb_types(self, x: DataFrameInfo) -> Dict[str, str]:
+        # 与生成的读取代码使用相同的数据源，只取关系的字段类型，不扫描数据
+        import duckdb
+        con = duckdb.connect()
+        if self.data_format == 'arrow':
+            with pa.memory_map(str(x.arrow_path)) as source:
+                relation = con.from_arrow(pa.ipc.open_file(source).schema.empty_table())
+        elif self.data_format == 'source' and x.path.suffix == '.csv':
+            relation = con.read_csv(str(x.path))
+        else:
+            relation = con.read_parquet(str(x.cache_path))
+        types = dict(zip(relation.columns, map(str, relation.types)))
+        con.close()
+        return types
+
     @staticmethod
     def pd_read_method(path: Path):
         suffix = path.suffix
@@ -62,13 +240,41 @@ class QueryPrompt(BaseModel):
             return 'pd.read_csv'
         raise Exception('not found')
 
-    @staticmethod
-    def import_package():
-        return 'import pandas as pd'
+    def import_package(self):
+        packages = ['import pandas as pd']
+        if self.data_format == 'arrow':
+            packages.append('import pyarrow as pa')
+        if self.engine == 'duckdb':
+            packages += ['import duckdb', '', 'con = duckdb.connect()']
+        packages[1:1] = [x for x in export_imports(self.output_format) if x not in packages]
+        return '\n'.join(packages)
 
     def export_result(self):
-        return f'df_result.to_csv("{self.file_name}")'
+        # 脚本可能在沙箱的工作目录中执行，输出路径使用绝对路径
+        return export_code(self.file_name, self.output_format, self.export_chunk_rows, self.engine)
 
     def exec_function(self):
-        args_string = [f'df_{n}=df_{n}' for n in range(len(self.dfs))]
+        # 修复重试时复用内核中已经读取的 df_i，浅拷贝后传入，写时复制保证失败的尝试原地修改不会影响读取的数据
+        # duckdb 的关系对象不可变，不需要拷贝
+        copy = '.copy(deep=False)' if self.engine == 'pandas' else ''
+        args_string = [f'df_{n}=df_{n}{copy}' for n in range(len(self.dfs))]
         return f'df_result = process_data({", ".join(args_string)})'
+
+    def code_cells(self, define_function_code: str) -> List[str]:
+        return [self.import_package(),
+                self.read_pd_data(),
+                define_function_code,
+                self.exec_function(),
+                self.export_result()]
+
+    @staticmethod
+    def repair_prompt(error: str, max_chars: int = 4000) -> str:
+        # 出错之后的代码块会继续报出连带的错误，最前面的 traceback 才是根本原因
+        return REPAIR_TMPL.format(error=error[:max_chars])
+
+    def repair_cells(self, define_function_code: str) -> List[str]:
+        # 修复重试时只重新定义并执行 process_data，复用内核中已经读取的 df_i
+        return self.code_cells(define_function_code)[self.REPAIR_FROM:]
+
+    def execution_key(self, define_function_code: str) -> str:
+        return execution_cache.make_key(self.code_cells(define_function_code), [x.path for x in self.dfs])
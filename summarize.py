@@ -0,0 +1,137 @@
+import re
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from pydantic import BaseModel, Field
+
+from introspect import ColumnSchema, TableSchema
+
+MIN_FAMILY_SIZE = 3
+FAMILY_EXAMPLES = 3
+FAMILY_SEPARATORS = re.compile(r'[-_/.：:（(]')
+CJK = re.compile(r'[一-鿿]')
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    # 优先使用 tiktoken，未安装时按中文一个字约一个 token、其他字符约 4 个一个 token 估算
+    if (encoding := _encoding()) is not None:
+        return len(encoding.encode(text))
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def name_score(name: str, text: str) -> float:
+    # 字段名称完整出现在提问中最相关，其次按字段名称中的字出现在提问中的比例
+    if name in text:
+        return 1.0
+    chars = [ch for ch in name if not ch.isdigit() and ch.strip() and not FAMILY_SEPARATORS.match(ch)]
+    return 0.5 * sum(ch in text for ch in chars) / len(chars) if chars else 0.0
+
+
+class ColumnEntry(BaseModel):
+    names: List[str] = Field(description='包含的字段名称，字段族包含多个字段')
+    text: str = Field(description='展示的内容')
+    position: int = Field(description='第一个字段在表中的位置')
+
+
+def _column_text(c: ColumnSchema) -> str:
+    return f'- {c.name}: {c.dtype}, {c.non_null} non-null'
+
+
+def _family_text(label: str, members: List[ColumnSchema], text: str) -> str:
+    dtypes = '/'.join(sorted({c.dtype for c in members}))
+    # 提问中出现的字段优先作为示例
+    examples = '、'.join(c.name for c in sorted(members, key=lambda c: -name_score(c.name, text))[:FAMILY_EXAMPLES])
+    return f'- {label}: {len(members)} 个字段, {dtypes}, 例如 {examples}'
+
+
+def collapse_families(columns: List[ColumnSchema], text: str = '') -> List[ColumnEntry]:
+    # 只有数字不同的字段（如 1月销售额、2月销售额）以及相同前缀的字段（如 支付方式-现金、支付方式-微信）合并展示
+    # 提问中完整出现的字段单独展示，不会只作为字段族的示例出现或被省略
+    exact = {i for i, c in enumerate(columns) if name_score(c.name, text) == 1.0}
+    groups: Dict[str, List[int]] = defaultdict(list)
+    for i, c in enumerate(columns):
+        if i not in exact:
+            groups[re.sub(r'\d+', '{n}', c.name)].append(i)
+    family_of = {i: key for key, idx in groups.items() if len(idx) >= MIN_FAMILY_SIZE and '{n}' in key for i in idx}
+
+    groups = defaultdict(list)
+    for i, c in enumerate(columns):
+        if i not in family_of and i not in exact and len(parts := FAMILY_SEPARATORS.split(c.name, 1)) == 2 and parts[0]:
+            groups[c.name[:len(parts[0]) + 1] + '*'].append(i)
+    family_of.update({i: key for key, idx in groups.items() if len(idx) >= MIN_FAMILY_SIZE for i in idx})
+
+    entries, members = [], defaultdict(list)
+    for i, c in enumerate(columns):
+        if i in family_of:
+            members[family_of[i]].append(i)
+        else:
+            entries.append(ColumnEntry(names=[c.name], text=_column_text(c), position=i))
+    for label, idx in members.items():
+        family = [columns[i] for i in idx]
+        entries.append(ColumnEntry(names=[c.name for c in family],
+                                   text=_family_text(label, family, text),
+                                   position=idx[0]))
+    return sorted(entries, key=lambda x: x.position)
+
+
+def relevance(entry: ColumnEntry, text: str) -> float:
+    return max(name_score(name, text) for name in entry.names)
+
+
+def _header(name: str, schema: TableSchema, shown: int) -> str:
+    header = f'{name}\nrows: {schema.rows}, columns: {len(schema.columns)}'
+    if shown < len(schema.columns):
+        header += f'（展示 {shown} 个字段，其余 {len(schema.columns) - shown} 个字段省略）'
+    return header
+
+
+def _render(tables: List[Tuple[str, TableSchema]], entries: List[List[ColumnEntry]]) -> str:
+    result = []
+    for (name, schema), table_entries in zip(tables, entries):
+        shown = sum(len(e.names) for e in table_entries)
+        body = '\n'.join(e.text for e in sorted(table_entries, key=lambda x: x.position))
+        result.append(f'{_header(name, schema, shown)}\n```\n{body}\n```\n')
+    return '\n'.join(result)
+
+
+@lru_cache(maxsize=128)
+def _summarize(tables_json: Tuple[Tuple[str, str], ...], text: str, budget: int) -> str:
+    tables = [(name, TableSchema.model_validate_json(schema)) for name, schema in tables_json]
+
+    # 不需要省略时逐个展示字段
+    full = [[ColumnEntry(names=[c.name], text=_column_text(c), position=i) for i, c in enumerate(schema.columns)]
+            for _, schema in tables]
+    if count_tokens(summary := _render(tables, full)) <= budget:
+        return summary
+
+    # 按与提问的相关程度从高到低加入字段，直到达到 token 预算，相同相关程度时靠前的字段优先
+    candidates = [(relevance(e, text), t, e) for t, (_, schema) in enumerate(tables)
+                  for e in collapse_families(schema.columns, text)]
+    candidates.sort(key=lambda x: (-x[0], x[2].position))
+
+    chosen = [[] for _ in tables]
+    used = count_tokens(_render(tables, chosen))
+    for _, t, entry in candidates:
+        # 表头中省略数量的变化只有几个 token，按字段行的长度估算即可
+        cost = count_tokens(entry.text + '\n')
+        if used + cost > budget:
+            continue
+        chosen[t].append(entry)
+        used += cost
+    return _render(tables, chosen)
+
+
+def summarize_tables(tables: List[Tuple[str, TableSchema]], text: str, budget: int) -> str:
+    # 表结构来自按文件内容哈希缓存的扫描结果，相同的表结构、提问与预算直接返回缓存的摘要
+    return _summarize(tuple((name, schema.model_dump_json()) for name, schema in tables), text, budget)
@@ -27,6 +27,38 @@ def process_data(*args, **kwargs) -> pd.DataFrame:
 ```
 """
 
+DUCKDB_MAIN_TMPL = """
+# 任务描述
+1. 根据提示的内容，补充缺失的 process_data 函数的代码
+2. 输入的 df_0 ... df_n 是 DuckDB 的关系对象（duckdb.DuckDBPyRelation），不是 pandas DataFrame
+3. 使用 DuckDB 的关系 API 或者 con.sql 完成数据处理，SQL 中可以直接用变量名引用关系，例如 con.sql("SELECT * FROM df_0")
+4. 不要调用 .df()、.fetchall() 等方法把完整数据加载到内存中，返回值必须是 duckdb.DuckDBPyRelation
+
+# DataFrame 表信息描述
+{dataframe_desc}
+
+# 提示内容
+{query}
+
+
+# 代码生成
+```python
+{import_package}
+
+{read_pd_data}
+
+def process_data(*args, **kwargs) -> duckdb.DuckDBPyRelation:
+    # 补充代码
+    ...
+
+# 最终结果的关系对象
+{exec_function}
+
+# 保存输出的结果
+{export_result}
+```
+"""
+
 GEN_OPERATION_TMPL = """
 1. 现在你要作为一个产品的角色，针对以下需求文档的描述，生成一份数据逻辑处理过程的简要描述大纲文档
 2. 这份描述必须写清楚每一个步骤的主要操作要点和流程，让程序编写人员能够根据步骤完成开发工作
@@ -59,3 +91,15 @@ GEN_OPERATION_TMPL = """
 {content}
 ```
 """
+
+REPAIR_TMPL = """
+上面的 process_data 函数执行出错，错误信息如下：
+
+```
+{error}
+```
+
+# 任务描述
+1. 根据错误信息修正 process_data 函数，只返回修正后完整的 process_data 函数定义
+2. df_0 ... df_n 已经读取完成，不要重新读取数据，也不要原地修改输入的 df_0 ... df_n
+"""
@@ -1,11 +1,13 @@
-import os
 import re
 
 import instructor
 from dotenv import load_dotenv
-from openai import OpenAI, Stream
+from openai import Stream
 from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
+from llm_cache import completion_cache
+from llm_client import get_async_client, get_client
+
 load_dotenv()
 
 
@@ -21,17 +23,51 @@ def call_openai_llm(messages,
                     temperature=0.0,
                     stream=False,
                     response_model=None,
+                    use_cache=True,
                     ):
 
-    client = OpenAI(base_url=os.getenv('BASE_URL'), api_key=os.getenv('API_KEY'))
-    if response_model is None:
-        return client.chat.completions.create(model=model,
-                                              stream=stream,
-                                              temperature=temperature,
-                                              messages=messages)
-    else:
-        return instructor.from_openai(client).chat.completions.create(model=model,
-                                                                      stream=stream,
-                                                                      response_model=response_model,
-                                                                      temperature=temperature,
-                                                                      messages=messages)
+    def create():
+        client = get_client()
+        if response_model is None:
+            return client.chat.completions.create(model=model,
+                                                  stream=stream,
+                                                  temperature=temperature,
+                                                  messages=messages)
+        else:
+            return instructor.from_openai(client).chat.completions.create(model=model,
+                                                                          stream=stream,
+                                                                          response_model=response_model,
+                                                                          temperature=temperature,
+                                                                          messages=messages)
+
+    if not use_cache:
+        return create()
+    return completion_cache.cached_create(create,
+                                          model=model,
+                                          temperature=temperature,
+                                          messages=messages,
+                                          stream=stream,
+                                          response_model=response_model)
+
+
+async def acall_openai_llm(messages,
+                           model='gpt-3.5-turbo',
+                           temperature=0.0,
+                           response_model=None,
+                           use_cache=True,
+                           ):
+    client = get_async_client()
+
+    def create():
+        return client.create(model=model,
+                             temperature=temperature,
+                             messages=messages,
+                             response_model=response_model)
+
+    if not use_cache:
+        return await create()
+    return await completion_cache.acached_create(create,
+                                                 model=model,
+                                                 temperature=temperature,
+                                                 messages=messages,
+                                                 response_model=response_model)